@@ -0,0 +1 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
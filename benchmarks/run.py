@@ -0,0 +1,178 @@
+"""
+Times the exports of synthetic forms of growing sizes against a local
+stand-in of the API, e.g.
+
+    python -m benchmarks.run --sizes 100,1000,10000 --output results.json
+
+Every case runs in its own process, starting from an empty submission
+store, and reports its wall time, throughput and peak resident memory.
+"""
+from __future__ import absolute_import, unicode_literals, division, print_function
+
+import argparse
+from collections import OrderedDict
+import json
+from multiprocessing import Process, Queue
+import os
+import resource
+import shutil
+import sys
+from tempfile import mkdtemp
+import time
+
+from pyxform import create_survey_element_from_dict
+
+from utils.formhub_utils import build_export_builder
+from .server import API_TOKEN, StandInForm, StandInServer
+from .synthetic import make_form, make_submissions
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def export_builder(form):
+    return build_export_builder(create_survey_element_from_dict(json.loads(json.dumps(form.definition))))
+
+
+def consume(chunks, path):
+    with open(path, 'wb') as output:
+        for chunk in chunks:
+            output.write(chunk)
+
+
+def run_kobo_to_excel(worker, form, directory):
+    worker.kobo_to_excel(form.pk, API_TOKEN, os.path.join(directory, 'data.xlsx'))
+
+
+def run_stream_excel(worker, form, directory):
+    consume(worker.stream_excel(form.pk, API_TOKEN), os.path.join(directory, 'stream.xlsx'))
+
+
+def run_generate_joined(worker, form, directory):
+    with open(os.path.join(directory, 'joined.xlsx'), 'wb') as output:
+        worker.generate_joined(form.pk, API_TOKEN, output)
+
+
+def run_do_work(worker, form, directory):
+    worker.do_work(form.pk, API_TOKEN)
+
+
+def run_to_xls_export(worker, form, directory):
+    export_builder(form).to_xls_export(os.path.join(directory, 'builder.xlsx'), form.submissions)
+
+
+def run_to_zipped_csv(worker, form, directory):
+    export_builder(form).to_zipped_csv(os.path.join(directory, 'builder.zip'), form.submissions)
+
+
+CASES = OrderedDict([
+    ('kobo_to_excel', run_kobo_to_excel),
+    ('stream_excel', run_stream_excel),
+    ('generate_joined', run_generate_joined),
+    ('do_work', run_do_work),
+    ('to_xls_export', run_to_xls_export),
+    ('to_zipped_csv', run_to_zipped_csv),
+])
+
+
+def measure(name, form, directory, results):
+    """
+    Runs in a child process: times one case and puts its measurements on
+    the results queue.
+    """
+    from utils import worker
+
+    try:
+        worker.submission_store.clear(form.pk)
+        rss_before = peak_rss_mb()
+        started = time.time()
+        CASES[name](worker, form, directory)
+        elapsed = time.time() - started
+        results.put({'seconds': elapsed, 'peak_rss_mb': peak_rss_mb(), 'rss_before_mb': rss_before})
+    except Exception as e:
+        results.put({'error': "{}".format(e)})
+
+
+def run_case(name, form, directory):
+    results = Queue()
+    process = Process(target=measure, args=(name, form, directory, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100,1000,5000', help='comma separated numbers of submissions')
+    parser.add_argument('--cases', default=','.join(CASES), help='comma separated cases to run')
+    parser.add_argument('--depth', type=int, default=3, help='nested groups in the form')
+    parser.add_argument('--questions', type=int, default=7, help='questions per group and repeat')
+    parser.add_argument('--select-multiples', type=int, default=10, help='select all that apply questions')
+    parser.add_argument('--choices', type=int, default=8, help='choices per select question')
+    parser.add_argument('--repeats', type=int, default=2, help='nested repeats in the form')
+    parser.add_argument('--itemsets', type=int, default=2, help='select one questions using a choice list')
+    parser.add_argument('--max-repeats', type=int, default=3, help='most entries a submission has in a repeat')
+    parser.add_argument('--processes', type=int, default=0, help='KOBO_TRANSFORM_PROCESSES for the exports')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    arguments = parse_arguments(argv)
+    sizes = [int(size) for size in arguments.sizes.split(',')]
+    cases = arguments.cases.split(',')
+    for name in cases:
+        if name not in CASES:
+            raise Exception("Unknown case {}".format(name))
+
+    definition = make_form(depth=arguments.depth, questions=arguments.questions,
+                           select_multiples=arguments.select_multiples, choices=arguments.choices,
+                           repeats=arguments.repeats, itemsets=arguments.itemsets)
+    forms = dict((size, StandInForm(size, definition, list(
+        make_submissions(definition, size, max_repeats=arguments.max_repeats)))) for size in sizes)
+
+    directory = mkdtemp()
+    server = StandInServer(forms).start()
+
+    # the worker reads these when it is first imported
+    os.environ['KOBO_API_URL'] = server.url
+    os.environ['KOBO_SUBMISSION_STORE'] = os.path.join(directory, 'submissions.sqlite3')
+    os.environ['KOBO_TRANSFORM_PROCESSES'] = "{}".format(arguments.processes)
+
+    results = []
+    print("{:<22}{:>12}{:>10}{:>14}{:>10}{:>10}".format('case', 'submissions', 'seconds', 'submissions/s',
+                                                         'peak MB', 'delta MB'))
+    try:
+        for size in sizes:
+            form = forms[size]
+            for name in cases:
+                result = run_case(name, form, directory)
+                result.update({'case': name, 'submissions': size})
+                results.append(result)
+
+                if 'error' in result:
+                    print("{:<22}{:>12}  failed: {}".format(name, size, result['error']))
+                    continue
+
+                print("{:<22}{:>12}{:>10.2f}{:>14.1f}{:>10.1f}{:>10.1f}".format(
+                    name, size, result['seconds'], size / result['seconds'] if result['seconds'] else 0,
+                    result['peak_rss_mb'], result['peak_rss_mb'] - result['rss_before_mb']))
+    finally:
+        server.stop()
+        shutil.rmtree(directory)
+
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+A local stand-in for the parts of the Kobo/Ona API KoboTools uses, serving
+synthetic forms from memory.
+"""
+from __future__ import absolute_import, unicode_literals, division, print_function
+
+import json
+import threading
+
+from flask import Flask, Response, request
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+API_TOKEN = 'benchmark'
+
+
+class StandInForm(object):
+    def __init__(self, pk, definition, submissions):
+        self.pk = pk
+        self.definition = definition
+        self.submissions = submissions
+
+    def metadata(self):
+        return {
+            'formid': self.pk,
+            'title': self.definition['title'],
+            'id_string': self.definition['id_string'],
+            'version': '1',
+            'date_modified': '2016-01-01T00:00:00',
+            'num_of_submissions': len(self.submissions)
+        }
+
+
+def make_app(forms):
+    """
+    forms is a dictionary of pk -> StandInForm.
+    """
+    app = Flask(__name__)
+
+    def json_response(data):
+        return Response(json.dumps(data), mimetype='application/json')
+
+    def get_form(pk):
+        if pk not in forms:
+            return None
+        return forms[pk]
+
+    @app.route('/user')
+    def user():
+        return json_response({'username': 'benchmark', 'api_token': API_TOKEN})
+
+    @app.route('/forms')
+    def form_list():
+        return json_response([form.metadata() for pk, form in sorted(forms.items())])
+
+    @app.route('/forms/<int:pk>')
+    def form_metadata(pk):
+        form = get_form(pk)
+        if form is None:
+            return json_response({'detail': 'Not found.'})
+        return json_response(form.metadata())
+
+    @app.route('/forms/<int:pk>/form.json')
+    def form_json(pk):
+        form = get_form(pk)
+        if form is None:
+            return json_response({'detail': 'Not found.'})
+        return json_response(form.definition)
+
+    @app.route('/data/<int:pk>')
+    def data(pk):
+        form = get_form(pk)
+        if form is None:
+            return json_response({'detail': 'Not found.'})
+
+        submissions = form.submissions
+        query = json.loads(request.args.get('query', '{}'))
+        after = query.get('_id', {}).get('$gt')
+        if after is not None:
+            submissions = [s for s in submissions if s['_id'] > after]
+        # like a mongo $gte, submissions never edited do not match
+        edited_since = query.get('_last_edited', {}).get('$gte')
+        if edited_since is not None:
+            submissions = [s for s in submissions
+                           if s.get('_last_edited') is not None and s['_last_edited'] >= edited_since]
+
+        start = int(request.args.get('start', 0))
+        limit = request.args.get('limit')
+        if limit is not None:
+            submissions = submissions[start:start + int(limit)]
+        else:
+            submissions = submissions[start:]
+
+        fields = request.args.get('fields')
+        if fields is not None:
+            fields = json.loads(fields)
+            submissions = [dict((field, s[field]) for field in fields if field in s) for s in submissions]
+
+        return json_response(submissions)
+
+    return app
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class StandInServer(object):
+    """
+    Serves make_app(forms) on a free local port from a background thread.
+    """
+
+    def __init__(self, forms):
+        self.forms = forms
+        self.server = make_server('127.0.0.1', 0, make_app(forms), threaded=True,
+                                  request_handler=QuietRequestHandler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
@@ -0,0 +1,169 @@
+"""
+Synthetic form definitions, in the JSON pyxform produces for
+/forms/{pk}/form.json, and random submissions that answer them.
+"""
+from __future__ import absolute_import, unicode_literals, division, print_function
+
+import random
+
+QUESTION_TYPES = ['integer', 'decimal', 'text', 'date', 'select one', 'select all that apply', 'geopoint']
+
+
+def make_choices(prefix, count):
+    return [{"name": "{}{}".format(prefix, i), "label": {"English": "Choice {} {}".format(prefix, i)}}
+            for i in range(count)]
+
+
+def make_questions(prefix, count, choices):
+    questions = []
+    for i in range(count):
+        question_type = QUESTION_TYPES[i % len(QUESTION_TYPES)]
+        question = {
+            "type": question_type,
+            "name": "{}_q{}".format(prefix, i),
+            "label": {"English": "{} question {}".format(prefix, i)}
+        }
+        if question_type.startswith('select'):
+            question['children'] = make_choices('c', choices)
+        questions.append(question)
+    return questions
+
+
+def make_form(depth=3, questions=7, select_multiples=10, choices=8, repeats=2, itemsets=2):
+    """
+    Returns a form with:
+        - questions of every exported type at the top level,
+        - depth nested groups with questions at every level,
+        - select_multiples select all that apply questions,
+        - itemsets select one questions taking their choices from a list,
+        - repeats nested repeats, each with its own questions,
+        - start, end and meta/instanceID.
+    """
+    children = [{"type": "start", "name": "start"}, {"type": "end", "name": "end"}]
+    children.extend(make_questions('top', questions, choices))
+
+    for i in range(select_multiples):
+        children.append({
+            "type": "select all that apply",
+            "name": "multiple_{}".format(i),
+            "label": {"English": "Multiple {}".format(i)},
+            "children": make_choices('m', choices)
+        })
+
+    for i in range(itemsets):
+        children.append({
+            "type": "select one",
+            "name": "itemset_{}".format(i),
+            "label": {"English": "Itemset {}".format(i)},
+            "itemset": "list_{}".format(i)
+        })
+
+    parent = children
+    for level in range(depth):
+        group = {
+            "type": "group",
+            "name": "group_{}".format(level),
+            "label": {"English": "Group {}".format(level)},
+            "children": make_questions('group_{}'.format(level), questions, choices)
+        }
+        parent.append(group)
+        parent = group['children']
+
+    parent = children
+    for level in range(repeats):
+        repeat = {
+            "type": "repeat",
+            "name": "repeat_{}".format(level),
+            "label": {"English": "Repeat {}".format(level)},
+            "children": make_questions('repeat_{}'.format(level), questions, choices)
+        }
+        parent.append(repeat)
+        parent = repeat['children']
+
+    children.append({
+        "type": "group",
+        "name": "meta",
+        "control": {"bodyless": True},
+        "children": [{
+            "type": "calculate",
+            "name": "instanceID",
+            "bind": {"readonly": "true()", "calculate": "concat('uuid:', uuid())"}
+        }]
+    })
+
+    return {
+        "name": "data",
+        "type": "survey",
+        "title": "Benchmark",
+        "id_string": "benchmark",
+        "sms_keyword": "benchmark",
+        "default_language": "default",
+        "choices": dict(("list_{}".format(i), make_choices('l', choices)) for i in range(itemsets)),
+        "children": children
+    }
+
+
+def answer(question, rnd, lists):
+    question_type = question['type']
+    if question_type == 'integer':
+        return "{}".format(rnd.randint(0, 1000))
+    if question_type == 'decimal':
+        return "{:.4f}".format(rnd.uniform(0, 1000))
+    if question_type == 'text':
+        return "text {}".format(rnd.randint(0, 100000))
+    if question_type == 'date':
+        return "2016-{:02d}-{:02d}".format(rnd.randint(1, 12), rnd.randint(1, 28))
+    if question_type in ['start', 'end']:
+        return "2016-{:02d}-{:02d}T{:02d}:00:00".format(rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 23))
+    if question_type == 'geopoint':
+        return "{:.6f} {:.6f} {:.1f} {:.1f}".format(
+            rnd.uniform(-90, 90), rnd.uniform(-180, 180), rnd.uniform(0, 100), rnd.uniform(0, 20))
+    if question_type == 'select one':
+        if question.get('itemset'):
+            return rnd.choice(lists[question['itemset']])['name']
+        return rnd.choice(question['children'])['name']
+    if question_type == 'select all that apply':
+        names = [c['name'] for c in question['children']]
+        return " ".join(rnd.sample(names, rnd.randint(0, len(names))))
+    return None
+
+
+def fill(children, prefix, rnd, max_repeats, lists):
+    values = {}
+    for child in children:
+        xpath = prefix + child['name']
+        if child['type'] == 'group':
+            values.update(fill(child['children'], xpath + '/', rnd, max_repeats, lists))
+        elif child['type'] == 'repeat':
+            repeats = [fill(child['children'], xpath + '/', rnd, max_repeats, lists)
+                       for i in range(rnd.randint(0, max_repeats))]
+            if repeats:
+                values[xpath] = repeats
+        else:
+            value = answer(child, rnd, lists)
+            if value:
+                values[xpath] = value
+    return values
+
+
+def make_submissions(form, count, max_repeats=3, seed=1):
+    """
+    Yields count submissions to form as /data/{pk} returns them, with up to
+    max_repeats entries in every repeat.
+    """
+    rnd = random.Random(seed)
+    for i in range(count):
+        submission = fill(form['children'], '', rnd, max_repeats, form['choices'])
+        submission.update({
+            "_id": i + 1,
+            "_uuid": "benchmark-{}".format(i),
+            "_submission_time": "2016-{:02d}-{:02d}T00:00:00".format(i % 12 + 1, i % 28 + 1),
+            "_xform_id_string": form['id_string'],
+            "_status": "submitted_via_web",
+            "_tags": [],
+            "_notes": [],
+            "_attachments": [],
+            "_geolocation": [None, None],
+            "meta/instanceID": "uuid:benchmark-{}".format(i)
+        })
+        yield submission
@@ -1,20 +1,46 @@
 from tempfile import NamedTemporaryFile
+from datetime import timedelta
+from functools import partial
 import json
+import os
 
-from flask import Flask, send_file, send_from_directory, make_response
-from flask import request
-import requests
+from flask import Flask, Response, abort, send_file, send_from_directory, make_response
+from flask import request, session, stream_with_context
 
-from utils.worker import fetch_api_key, kobo_to_excel, ONA_API_URL, generate_joined
+from utils import metrics
+from utils.worker import fetch_api_key, fetch_form_list, kobo_to_excel, generate_joined, stream_excel, \
+    stream_zipped_csv, stream_batch
+from utils.streaming import XLSX_MIMETYPE, ZIP_MIMETYPE
+from utils.jobs import JobQueue
+from utils.tokens import SECRET_KEY, TOKEN_TTL, TokenCache, credentials_key, new_session_key
 
 app = Flask(__name__)
+app.secret_key = SECRET_KEY
+app.permanent_session_lifetime = timedelta(seconds=TOKEN_TTL)
+jobs = JobQueue()
+tokens = TokenCache()
 
 
-@app.route('/fetch-token', methods=['POST'])
-def fetch_token():
-    user = json.loads(request.data)
-    token = fetch_api_key(user['username'], user['password'])
+def session_token():
+    key = session.get('token_key')
+    return tokens.get(key) if key else None
+
 
+def request_token(token=None):
+    """
+    Returns the token sent with the request, or else the one of the session
+    if the request has an X-Requested-With header. Other sites cannot send
+    that header, so they cannot make exports with a visitor's session.
+    Aborts with 401 when there is no token.
+    """
+    if not token and request.headers.get('X-Requested-With'):
+        token = session_token()
+    if not token:
+        abort(401)
+    return token
+
+
+def token_response(token):
     response = make_response(json.dumps({
         'token': token
     }))
@@ -23,23 +49,64 @@ def fetch_token():
     return response
 
 
+@app.route('/fetch-token', methods=['POST'])
+def fetch_token():
+    user = json.loads(request.data)
+
+    # the same credentials get the same token until it expires, without
+    # asking the API again
+    key = credentials_key(user['username'], user['password'])
+    token = tokens.get(key)
+    if token is None:
+        token = fetch_api_key(user['username'], user['password'])
+        tokens.put(key, token)
+
+    session_key = new_session_key()
+    tokens.put(session_key, token)
+    session.permanent = True
+    session['token_key'] = session_key
+
+    return token_response(token)
+
+
+@app.route('/session')
+def current_session():
+    return token_response(session_token())
+
+
+@app.route('/logout', methods=['POST'])
+def logout():
+    key = session.pop('token_key', None)
+    if key:
+        tokens.pop(key)
+    return token_response(None)
+
+
 @app.route('/fetch-forms', methods=['POST'])
 def fetch_forms():
     user = json.loads(request.data)
-    headers = {"Authorization": "Token {}".format(user['token'])}
-    data = requests.get("{}/forms".format(ONA_API_URL), headers=headers).json()
-    response = make_response(json.dumps(data))
+    form_list = fetch_form_list(request_token(user.get('token')))
+
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = make_response(form_list.gzipped)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = make_response(form_list.body)
+
     response.headers['content-type'] = "application/json"
+    response.headers['Vary'] = 'Accept-Encoding'
     return response
 
 
 @app.route('/download-joined-data/<int:pk>', methods=['POST'])
 def download_joined_data(pk):
+    token = request_token(request.form.get('userToken'))
     try:
-        token = request.form.get('userToken', '')
-        with NamedTemporaryFile(suffix=".xlsx") as temp:
+        with NamedTemporaryFile(suffix=".xlsx") as temp, \
+                metrics.collect_timings('download-joined-data {}'.format(pk)) as timings:
                 generate_joined(pk, token, temp)
                 response = send_file(temp.name)
+                response.headers['Server-Timing'] = metrics.server_timing(timings)
                 temp.delete = True
 
         return response
@@ -49,12 +116,20 @@ def download_joined_data(pk):
 
 @app.route('/download-data/<int:pk>', methods=['POST'])
 def download_data(pk):
+    token = request_token(request.form.get('userToken'))
     try:
-        token = request.form.get('userToken', '')
-        with NamedTemporaryFile(suffix=".xlsx") as temp:
+        if request.values.get('stream'):
+            # the workbook is sent while it is being written, no temp file
+            return Response(stream_with_context(stream_excel(pk, token)), mimetype=XLSX_MIMETYPE, headers={
+                'Content-Disposition': 'attachment; filename={}.xlsx'.format(pk)
+            })
+
+        with NamedTemporaryFile(suffix=".xlsx") as temp, \
+                metrics.collect_timings('download-data {}'.format(pk)) as timings:
             kobo_to_excel(pk, token, temp.name)
 
             response = send_file(temp.name)
+            response.headers['Server-Timing'] = metrics.server_timing(timings)
             temp.delete = True
 
         return response
@@ -63,6 +138,90 @@ def download_data(pk):
     return ""
 
 
+@app.route('/download-csv/<int:pk>', methods=['POST'])
+def download_csv(pk):
+    token = request_token(request.form.get('userToken'))
+    try:
+        return Response(stream_with_context(stream_zipped_csv(pk, token)), mimetype=ZIP_MIMETYPE, headers={
+            'Content-Disposition': 'attachment; filename={}.zip'.format(pk)
+        })
+    except Exception as e:
+        print (e)
+    return ""
+
+
+@app.route('/download-batch', methods=['POST'])
+def download_batch():
+    token = request_token(request.form.get('userToken'))
+    try:
+        pks = [int(pk) for pk in request.form.get('pks', '').split(',') if pk]
+        return Response(stream_with_context(stream_batch(pks, token)), mimetype=ZIP_MIMETYPE, headers={
+            'Content-Disposition': 'attachment; filename=forms.zip'
+        })
+    except Exception as e:
+        print (e)
+    return ""
+
+
+def write_joined_data(pk, token, path):
+    with open(path, 'wb') as output:
+        generate_joined(pk, token, output)
+
+
+def write_batch(pks, token, path):
+    with open(path, 'wb') as output:
+        for data in stream_batch(pks, token):
+            output.write(data)
+
+
+def job_response(job):
+    response = make_response(json.dumps(job))
+    response.headers['content-type'] = "application/json"
+    return response
+
+
+@app.route('/jobs/download-data/<int:pk>', methods=['POST'])
+def queue_download_data(pk):
+    user = json.loads(request.data)
+    return job_response(jobs.submit(partial(kobo_to_excel, pk, request_token(user.get('token'))), 'download-data'))
+
+
+@app.route('/jobs/download-joined-data/<int:pk>', methods=['POST'])
+def queue_download_joined_data(pk):
+    user = json.loads(request.data)
+    return job_response(jobs.submit(partial(write_joined_data, pk, request_token(user.get('token'))), 'download-joined-data'))
+
+
+@app.route('/jobs/download-batch', methods=['POST'])
+def queue_download_batch():
+    user = json.loads(request.data)
+    pks = [int(pk) for pk in user['pks']]
+    return job_response(jobs.submit(partial(write_batch, pks, request_token(user.get('token'))), 'download-batch', suffix='.zip'))
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.status(job_id)
+    if job is None:
+        return make_response("", 404)
+    return job_response(job)
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    path = jobs.result_path(job_id)
+    if path is None:
+        return make_response("", 404)
+    response = send_file(path, as_attachment=True, attachment_filename=os.path.basename(path))
+    response.headers['Server-Timing'] = metrics.server_timing(jobs.status(job_id).get('timings', {}))
+    return response
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/static/<path:path>')
 def static_files(path):
     return send_from_directory('static', path)
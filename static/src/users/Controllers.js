@@ -19,8 +19,11 @@
         var self = this;
 
         self.loadForms = loadForms;
+        self.logout = logout;
         self.downloadData = downloadData;
         self.downloadJoinedData = downloadJoinedData;
+        self.downloadCsv = downloadCsv;
+        self.downloadAll = downloadAll;
 
         self.user = {
             username: '',
@@ -30,11 +33,49 @@
         self.formAction = "";
 
 
+        self.jobs = {};
+
+        // picks up the session of an earlier login, e.g. after a reload
+        $http.get('/session').then(function (d) {
+            if (d.data.token && !self.user.token) {
+                self.user.token = d.data.token;
+                loadForms();
+            }
+        });
+
+        function logout() {
+            self.user = {};
+            self.forms = [];
+            return $http.post('/logout');
+        }
+
+        function queueJob(url, pk, data) {
+            return $http.post(url, data || self.user).then(function (d) {
+                self.jobs[pk] = d.data;
+                pollJob(pk);
+            }).catch(function () {
+                alert('Could not start the export.');
+            });
+        }
+
+        function pollJob(pk) {
+            var job = self.jobs[pk];
+            $http.get('/jobs/' + job.id).then(function (d) {
+                self.jobs[pk] = d.data;
+                if (d.data.status === 'done') {
+                    window.location = '/jobs/' + job.id + '/result';
+                } else if (d.data.status === 'failed') {
+                    alert('The export failed: ' + d.data.error);
+                } else {
+                    $timeout(function () {
+                        pollJob(pk);
+                    }, 2000);
+                }
+            });
+        }
+
         function downloadJoinedData(pk) {
-            self.formAction = '/download-joined-data/' + pk;
-            $timeout(function () {
-                $('form[name=downloadForm]').submit();
-            }, 100);
+            return queueJob('/jobs/download-joined-data/' + pk, pk);
         }
 
         function loadForms() {
@@ -61,7 +102,20 @@
 
 
         function downloadData(pk) {
-            self.formAction = '/download-data/' + pk;
+            return queueJob('/jobs/download-data/' + pk, pk);
+        }
+
+        function downloadAll() {
+            return queueJob('/jobs/download-batch', 'all', {
+                token: self.user.token,
+                pks: self.forms.map(function (form) {
+                    return form.formid;
+                })
+            });
+        }
+
+        function downloadCsv(pk) {
+            self.formAction = '/download-csv/' + pk;
             $timeout(function () {
                 $('form[name=downloadForm]').submit();
             }, 100);
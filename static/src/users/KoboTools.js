@@ -1,7 +1,11 @@
 (function(){
   'use strict';
 
-  angular.module('koboTools', [ 'ngMaterial' ]);
+  angular.module('koboTools', [ 'ngMaterial' ])
+    .config(['$httpProvider', function ($httpProvider) {
+      // lets the server use the session's token for these requests
+      $httpProvider.defaults.headers.common['X-Requested-With'] = 'XMLHttpRequest';
+    }]);
 
 
 })();
@@ -0,0 +1,171 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+
+from collections import OrderedDict
+import json
+import os
+import tempfile
+import threading
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping that holds at most maxsize items, evicting the
+    least recently used one when full.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+
+class ResponseCache(object):
+    """
+    HTTP response bodies stored as files in directory, each with a JSON
+    file holding the validators (ETag, Last-Modified) to revalidate it.
+    Least recently used responses are removed once the bodies take more
+    than max_bytes, possibly by another process, so bodies are handed out
+    as open files rather than paths: an open file stays readable after its
+    body is removed.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def body_path(self, key):
+        return self._path(key, '.body')
+
+    def validators(self, key):
+        """
+        Returns the validators stored with the response under key, None when
+        there is no usable response.
+        """
+        try:
+            with open(self._path(key, '.json')) as f:
+                validators = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if not os.path.exists(self.body_path(key)):
+            return None
+        return validators
+
+    def open(self, key):
+        """
+        Returns the body stored under key opened for reading, marking it as
+        just used, or None when it has been removed.
+        """
+        try:
+            body = open(self.body_path(key), 'rb')
+        except (IOError, OSError):
+            return None
+
+        try:
+            os.utime(self.body_path(key), None)
+        except OSError:
+            pass
+        return body
+
+    def store(self, key, chunks, validators):
+        """
+        Writes the byte strings in chunks as the body of the response under
+        key and returns it opened for reading. The body is written to a
+        temporary file first, so readers never see a partial one. A body
+        larger than max_bytes is returned without being kept.
+        """
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass
+
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+            body = open(temp, 'rb')
+        except Exception:
+            os.remove(temp)
+            raise
+
+        if size > self.max_bytes:
+            os.remove(temp)
+            return body
+
+        os.rename(temp, self.body_path(key))
+
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(validators, f)
+        os.rename(temp, self._path(key, '.json'))
+
+        self.evict(keep=key)
+        return body
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used bodies, other than the one under
+        keep, until the rest take at most max_bytes.
+        """
+        with self._lock:
+            bodies = []
+            for name in os.listdir(self.directory):
+                if not name.endswith('.body'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                bodies.append((stat.st_mtime, stat.st_size, name[:-len('.body')]))
+
+            total = sum(size for mtime, size, key in bodies)
+            # counted, but never removed
+            bodies = [body for body in bodies if body[2] != keep]
+            for mtime, size, key in sorted(bodies):
+                if total <= self.max_bytes:
+                    break
+                for suffix in ('.body', '.json'):
+                    try:
+                        os.remove(self._path(key, suffix))
+                    except OSError:
+                        pass
+                total -= size
@@ -0,0 +1,212 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+
+import codecs
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+import requests
+from six.moves.http_cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from .cache import ResponseCache
+from .metrics import count
+
+# connections kept open to the API; should cover the web threads plus the
+# export workers of a process
+POOL_SIZE = int(os.environ.get('KOBO_HTTP_POOL_SIZE', 10))
+
+# seconds to wait for a connection and for the next bytes of a response
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 300
+
+# retries on connection errors and 5xx responses, waiting
+# BACKOFF_FACTOR * 2 ** (retry - 1) seconds between attempts
+RETRIES = 3
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# where cached_get keeps response bodies, and how many bytes of them
+HTTP_CACHE_DIR = os.environ.get(
+    'KOBO_HTTP_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'kobotools-http-cache'))
+HTTP_CACHE_MAX_BYTES = int(os.environ.get('KOBO_HTTP_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+# bytes read from the socket at a time when downloading into the cache
+CHUNK_SIZE = 64 * 1024
+
+
+def make_session():
+    """
+    Builds a requests session with a keep-alive connection pool and retries
+    with backoff, shared by every call made to the API. It keeps no cookies:
+    calls are made for many users, each authenticated by its own headers.
+    """
+    retry = Retry(total=RETRIES, backoff_factor=BACKOFF_FACTOR,
+                  status_forcelist=RETRY_STATUSES)
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE,
+                          max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    return session
+
+
+session = make_session()
+
+
+def get(url, **kwargs):
+    """
+    requests.get through the shared session, with the default timeouts.
+    """
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return session.get(url, **kwargs)
+
+
+response_cache = ResponseCache(HTTP_CACHE_DIR, HTTP_CACHE_MAX_BYTES)
+
+
+def cache_key(url, headers):
+    """
+    Responses are cached per URL and per credentials: the Authorization
+    header is part of the key, hashed.
+    """
+    authorization = (headers or {}).get('Authorization', '')
+    token = hashlib.sha256(authorization.encode('utf-8')).hexdigest()
+    return hashlib.sha256("{}\0{}".format(url, token).encode('utf-8')).hexdigest()
+
+
+def cached_get(url, headers=None):
+    """
+    GETs url through the response cache and returns the body as a file
+    opened for reading, for the caller to close. A cached response is
+    revalidated with If-None-Match/If-Modified-Since, so an unchanged one
+    costs a 304. Raises on error responses, which are never cached.
+    """
+    key = cache_key(url, headers)
+    validators = response_cache.validators(key)
+
+    request_headers = dict(headers or {})
+    if validators is not None:
+        if validators.get('etag'):
+            request_headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            request_headers['If-Modified-Since'] = validators['last_modified']
+
+    response = get(url, headers=request_headers, stream=True)
+    if validators is not None and response.status_code == 304:
+        response.close()
+        body = response_cache.open(key)
+        if body is not None:
+            count('http_cache_hits')
+            return body
+
+        # evicted, e.g. by another process, since it was revalidated
+        response = get(url, headers=headers, stream=True)
+
+    try:
+        if response.status_code >= 400:
+            raise Exception(response.text)
+
+        count('http_cache_misses')
+
+        def chunks():
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if chunk:
+                    count('downloaded_bytes', len(chunk))
+                    yield chunk
+
+        return response_cache.store(key, chunks(), {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')
+        })
+    finally:
+        response.close()
+
+
+# what json skips between values
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def iter_json_array(chunks):
+    """
+    Yields the items of the JSON array whose UTF-8 text is split across the
+    byte strings in chunks, each one as soon as it has been received, so
+    neither the whole text nor the whole array is ever held in memory.
+    Raises Exception with the decoded document when it is not an array,
+    e.g. an API error.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    started = False
+    finished = False
+
+    while True:
+        pos = WHITESPACE.match(buf, pos).end()
+
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != '[':
+                    # not an array: read the rest and report it
+                    rest = buf[pos:] + ''.join(text.decode(chunk) for chunk in chunks) + text.decode(b'', True)
+                    raise Exception(json.loads(rest))
+                started = True
+                pos += 1
+                continue
+
+            if buf[pos] == ']':
+                return
+
+            if buf[pos] == ',':
+                pos += 1
+                continue
+
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if finished:
+                    raise
+            else:
+                # only a separator proves the item complete: a number split
+                # across chunks, e.g. "2." + "5", also decodes
+                after = WHITESPACE.match(buf, end).end()
+                if after < len(buf) and buf[after] in ',]':
+                    yield item
+                    pos = after
+                    continue
+                if finished:
+                    raise ValueError("Malformed JSON array")
+        elif finished:
+            raise ValueError("Truncated JSON array")
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            finished = True
+            buf = buf[pos:] + text.decode(b'', True)
+        else:
+            buf = buf[pos:] + text.decode(chunk)
+        pos = 0
+
+
+def iter_json_items(response, chunk_size=CHUNK_SIZE):
+    """
+    iter_json_array over the body of a response requested with stream=True.
+    """
+    def chunks():
+        for chunk in response.iter_content(chunk_size):
+            if chunk:
+                count('downloaded_bytes', len(chunk))
+                yield chunk
+
+    return iter_json_array(chunks())
@@ -1,6 +1,7 @@
 from __future__ import absolute_import, unicode_literals, division, print_function
 
 import csv
+from collections import namedtuple
 from datetime import datetime, date
 import re
 from zipfile import ZipFile
@@ -13,6 +14,8 @@ from pyxform.builder import create_survey_element_from_dict
 from pyxform.question import Question
 from pyxform.section import Section, RepeatingSection
 
+from .streaming import DeflatedEntry, ZipStream
+
 
 """
 Constants "borrowed" from the formhub code
@@ -148,100 +151,279 @@ class DictOrganizer(object):
     # parent name, index, table name, data
     def _build_obs_from_dict(self, d, obs, table_name,
                              parent_table_name, parent_index):
-        if table_name not in obs:
-            obs[table_name] = []
-        this_index = len(obs[table_name])
-        obs[table_name].append({
-            u"_parent_table_name": parent_table_name,
-            u"_parent_index": parent_index,
-        })
-        for k, v in d.items():
-            if type(v) != dict and type(v) != list:
-                assert k not in obs[table_name][-1]
-                obs[table_name][-1][k] = v
-        obs[table_name][-1][u"_index"] = this_index
-
-        for k, v in d.items():
-            if type(v) == dict:
-                kwargs = {
-                    "d": v,
-                    "obs": obs,
-                    "table_name": k,
-                    "parent_table_name": table_name,
-                    "parent_index": this_index
-                }
-                self._build_obs_from_dict(**kwargs)
-            if type(v) == list:
-                for i, item in enumerate(v):
-                    kwargs = {
-                        "d": item,
-                        "obs": obs,
-                        "table_name": k,
-                        "parent_table_name": table_name,
-                        "parent_index": this_index,
-                    }
-                    self._build_obs_from_dict(**kwargs)
+        # the dicts still to add, next one last, so that tables are filled
+        # in the order a depth first walk reaches them
+        stack = [(d, table_name, parent_table_name, parent_index)]
+        while stack:
+            d, table_name, parent_table_name, parent_index = stack.pop()
+            if table_name not in obs:
+                obs[table_name] = []
+            this_index = len(obs[table_name])
+            row = {
+                u"_parent_table_name": parent_table_name,
+                u"_parent_index": parent_index,
+            }
+            obs[table_name].append(row)
+
+            children = []
+            for k, v in d.items():
+                if type(v) == dict:
+                    children.append((v, k, table_name, this_index))
+                elif type(v) == list:
+                    children.extend((item, k, table_name, this_index)
+                                    for item in v)
+                else:
+                    assert k not in row
+                    row[k] = v
+            row[u"_index"] = this_index
+
+            stack.extend(reversed(children))
         return obs
 
     def get_observation_from_dict(self, d):
         result = {}
         assert len(d.keys()) == 1
         root_name = d.keys()[0]
-        kwargs = {
-            "d": d[root_name],
-            "obs": result,
-            "table_name": root_name,
-            "parent_table_name": u"",
-            "parent_index": -1,
-        }
-        self._build_obs_from_dict(**kwargs)
+        self._build_obs_from_dict(d[root_name], result, root_name, u"", -1)
         return result
 
 
 def dict_to_joined_export(data, index, indices, name):
     """
-    Converts a dict into one or more tabular datasets
+    Converts a dict into one or more tabular datasets: its own row under
+    name and, under the name of every repeat, the rows of the repeat's
+    entries, numbered by indices in the order the recursive walk of the
+    submission would reach them.
     """
     output = {}
 
-    # TODO: test for _geolocation and attachment lists
-    if isinstance(data, dict):
+    # the dicts still to walk, next one last, with the row their values go
+    # into; the row of data itself is only made if it has values
+    stack = [(data, None, name, index)]
+    while stack:
+        data, row, name, index = stack.pop()
+
+        # TODO: test for _geolocation and attachment lists
+        if not isinstance(data, dict):
+            continue
+
+        children = []
         for key, val in data.iteritems():
-            if isinstance(val, list) and key not in [NOTES, TAGS]:
-                output[key] = []
+            if isinstance(val, list) and key not in (NOTES, TAGS):
+                rows = output.setdefault(key, [])
                 for child in val:
-                    if key not in indices:
-                        indices[key] = 0
-                    indices[key] += 1
-                    child_index = indices[key]
-                    new_output = dict_to_joined_export(
-                        child, child_index, indices, key)
-                    d = {INDEX: child_index, PARENT_INDEX: index,
-                         PARENT_TABLE_NAME: name}
-                    # iterate over keys within new_output and append to
-                    # main output
-                    for out_key, out_val in new_output.iteritems():
-                        if isinstance(out_val, list):
-                            if out_key not in output:
-                                output[out_key] = []
-                            output[out_key].extend(out_val)
-                        else:
-                            d.update(out_val)
-                    output[key].append(d)
+                    indices[key] = child_index = indices.get(key, 0) + 1
+                    child_row = {INDEX: child_index, PARENT_INDEX: index,
+                                 PARENT_TABLE_NAME: name}
+                    rows.append(child_row)
+                    children.append((child, child_row, key, child_index))
+                continue
+
+            if row is None:
+                row = output[name] = {}
+            if key == TAGS:
+                row[key] = ",".join(val)
+            elif key == NOTES:
+                row[key] = "\r\n".join([v['note'] for v in val])
             else:
-                if name not in output:
-                    output[name] = {}
-                if key in [TAGS]:
-                    output[name][key] = ",".join(val)
-                elif key in [NOTES]:
-                    output[name][key] = "\r\n".join(
-                        [v['note'] for v in val])
-                else:
-                    output[name][key] = val
+                row[key] = val
+
+        stack.extend(reversed(children))
 
     return output
 
 
+# what pre_process_row does to the rows of a section and the columns they are
+# written with, built by ExportBuilder.set_survey
+SectionPlan = namedtuple('SectionPlan', [
+    'name', 'fields', 'titles', 'converters', 'select_multiples',
+    'binary_select_multiples', 'gps_fields', 'encoded_fields'])
+
+
+class Missing(object):
+    """
+    The value of a column a row does not have, as opposed to a None value.
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'MISSING'
+
+    def __reduce__(self):
+        # unpickles to the module's single instance, by its (native) name
+        return str('MISSING')
+
+
+MISSING = Missing()
+
+
+class SectionRows(object):
+    """
+    The rows of a section as lists of values in the order of a list of
+    columns shared by all of them, rather than as a dict per row. Columns
+    start out as the fields of the section's plan; columns a row brings
+    that are not among them are added at the end. Renaming a column is a
+    change to the column list only.
+
+    Iterating yields each row as a dict of the values it has.
+    """
+
+    def __init__(self, columns=()):
+        self.columns = []
+        self.positions = {}
+        self.rows = []
+        for column in columns:
+            self.add_column(column)
+
+    def add_column(self, column):
+        position = self.positions[column] = len(self.columns)
+        self.columns.append(column)
+        return position
+
+    def append(self, row):
+        """
+        Adds a row given as a dict.
+        """
+        values = [MISSING] * len(self.columns)
+        for column, value in row.iteritems():
+            position = self.positions.get(column)
+            if position is None:
+                position = self.add_column(column)
+                values.append(MISSING)
+            values[position] = value
+        self.rows.append(values)
+
+    def extend(self, other):
+        """
+        Adds the rows of another SectionRows, whatever its columns.
+        """
+        positions = [self.positions[column] if column in self.positions else self.add_column(column)
+                     for column in other.columns]
+        for values in other.rows:
+            row = [MISSING] * len(self.columns)
+            for position, value in zip(positions, values):
+                if value is not MISSING:
+                    row[position] = value
+            self.rows.append(row)
+
+    def get(self, i, column, default=None):
+        position = self.positions.get(column)
+        values = self.rows[i]
+        if position is None or position >= len(values) or values[position] is MISSING:
+            return default
+        return values[position]
+
+    def set(self, i, column, value):
+        position = self.positions.get(column)
+        if position is None:
+            position = self.add_column(column)
+        values = self.rows[i]
+        if position >= len(values):
+            values.extend([MISSING] * (position + 1 - len(values)))
+        values[position] = value
+
+    def present_columns(self):
+        """
+        Returns the columns at least one row has a value for, in order.
+        """
+        present = [False] * len(self.columns)
+        for values in self.rows:
+            for position, value in enumerate(values):
+                if value is not MISSING:
+                    present[position] = True
+        return [column for column, has_value in zip(self.columns, present) if has_value]
+
+    def column(self, column):
+        """
+        Returns the values of column, one per row, MISSING where a row has
+        none.
+        """
+        position = self.positions.get(column)
+        if position is None:
+            return [MISSING] * len(self.rows)
+        return [values[position] if position < len(values) else MISSING for values in self.rows]
+
+    def set_column(self, column, column_values):
+        """
+        Replaces the values of column by column_values, one per row.
+        """
+        position = self.positions.get(column)
+        if position is None:
+            position = self.add_column(column)
+        for values, value in six.moves.zip(self.rows, column_values):
+            if position < len(values):
+                values[position] = value
+            else:
+                values.extend([MISSING] * (position - len(values)))
+                values.append(value)
+
+    def map_column(self, column, func):
+        """
+        Replaces every value of column by func(value).
+        """
+        position = self.positions.get(column)
+        if position is None:
+            return
+        for values in self.rows:
+            if position < len(values) and values[position] is not MISSING:
+                values[position] = func(values[position])
+
+    def rename(self, column, new_name):
+        """
+        Renames column. When new_name is already a column, the values of
+        column replace its values in the rows that have them.
+        """
+        if column == new_name or column not in self.positions:
+            return
+
+        position = self.positions.pop(column)
+        if new_name not in self.positions:
+            self.columns[position] = new_name
+            self.positions[new_name] = position
+            return
+
+        # the old column stays in place without a name and without values
+        self.columns[position] = None
+        for i, values in enumerate(self.rows):
+            if position < len(values) and values[position] is not MISSING:
+                value = values[position]
+                values[position] = MISSING
+                self.set(i, new_name, value)
+
+    def iter_values(self, columns, default=None):
+        """
+        Yields the values of columns for every row, default where a row has
+        none.
+        """
+        positions = [self.positions.get(column) for column in columns]
+        for values in self.rows:
+            size = len(values)
+            yield [default if p is None or p >= size or values[p] is MISSING else values[p] for p in positions]
+
+    def to_frame(self):
+        """
+        Returns the rows as a pandas DataFrame with a column for every
+        column with values, sorted, and NaN where a row has no value: what
+        DataFrame of the rows as a list of dicts gives, without the dicts.
+        """
+        import pandas
+
+        columns = sorted(self.present_columns())
+        if not columns:
+            return pandas.DataFrame([{}] * len(self.rows))
+
+        return pandas.DataFrame(
+            dict(zip(columns, zip(*self.iter_values(columns, float('nan'))))), columns=columns)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        for values in self.rows:
+            yield dict((column, value) for column, value in zip(self.columns, values)
+                       if value is not MISSING and column is not None)
+
+
 class ExportBuilder(object):
     IGNORED_COLUMNS = [XFORM_ID_STRING, STATUS, ATTACHMENTS, GEOLOCATION,
                        BAMBOO_DATASET_ID, DELETEDAT]
@@ -265,6 +447,12 @@ class ExportBuilder(object):
         'date': lambda x: ExportBuilder.string_to_date_with_xls_validation(x),
         'dateTime': lambda x: datetime.strptime(x[:19], '%Y-%m-%dT%H:%M:%S')
     }
+    # the types convert_column parses with numpy, with the numpy type of
+    # the CONVERT_FUNCS function
+    NUMPY_DTYPES = {
+        'int': int,
+        'decimal': float
+    }
 
     XLS_SHEET_NAME_MAX_CHARS = 31
 
@@ -382,6 +570,9 @@ class ExportBuilder(object):
             main_section, self.survey, self.sections,
             self.select_multiples, self.gps_fields, self.encoded_fields,
             self.GROUP_DELIMITER)
+        self.plans = dict(
+            (section['name'], self.build_plan(section))
+            for section in self.sections)
 
     def section_by_name(self, name):
         matches = filter(lambda s: s['name'] == name, self.sections)
@@ -445,39 +636,187 @@ class ExportBuilder(object):
         except ValueError:
             return value
 
+    @classmethod
+    def converter(cls, data_type):
+        """
+        Returns a callable doing convert_type(value, data_type)
+        """
+        func = ExportBuilder.CONVERT_FUNCS.get(data_type, lambda x: x)
+
+        def convert(value):
+            try:
+                return func(value)
+            except ValueError:
+                return value
+
+        return convert
+
+    def build_plan(self, section):
+        """
+        Works out once what pre_process_row has to do to every row of a
+        section
+        """
+        section_name = section['name']
+
+        converters = []
+        converted = set()
+        for element in section['elements']:
+            if element['type'] in self.TYPES_TO_CONVERT \
+                    and element['xpath'] not in converted:
+                converted.add(element['xpath'])
+                converters.append((element['xpath'], element['type'],
+                                   ExportBuilder.converter(element['type'])))
+
+        # choices are paired with the name they are selected by
+        select_multiples = []
+        if self.SPLIT_SELECT_MULTIPLES:
+            for xpath, choices in self.select_multiples.get(
+                    section_name, {}).iteritems():
+                select_multiples.append((xpath, tuple(
+                    (choice, choice[len(xpath) + 1:]) for choice in choices)))
+
+        return SectionPlan(
+            name=section_name,
+            fields=tuple([element['xpath'] for element in
+                          section['elements']] + self.EXTRA_FIELDS),
+            titles=tuple([element['title'] for element in
+                          section['elements']] + self.EXTRA_FIELDS),
+            converters=tuple(converters),
+            select_multiples=tuple(select_multiples),
+            binary_select_multiples=self.BINARY_SELECT_MULTIPLES,
+            gps_fields=tuple(
+                (xpath, tuple(components)) for xpath, components in
+                self.gps_fields.get(section_name, {}).iteritems()),
+            encoded_fields=tuple(
+                (xpath, encoded_xpath) for xpath, encoded_xpath in
+                self.encoded_fields.get(section_name, {}).iteritems()
+                if xpath != encoded_xpath))
+
     def pre_process_row(self, row, section):
         """
         Split select multiples, gps and decode . and $
         """
-        section_name = section['name']
+        plan = self.plans[section['name']]
 
         # first decode fields so that subsequent lookups
         # have decoded field names
-        if section_name in self.encoded_fields:
-            row = ExportBuilder.decode_encoded_fields(
-                row, self.encoded_fields[section_name])
-
-        if self.SPLIT_SELECT_MULTIPLES and \
-                        section_name in self.select_multiples:
-            row = ExportBuilder.split_select_multiples(
-                row, self.select_multiples[section_name])
-
-        if section_name in self.gps_fields:
-            row = ExportBuilder.split_gps_components(
-                row, self.gps_fields[section_name])
-
-        # convert to native types
-        for elm in section['elements']:
-            # only convert if its in our list and its not empty, just to
-            # optimize
-            value = row.get(elm['xpath'])
-            if elm['type'] in ExportBuilder.TYPES_TO_CONVERT \
-                    and value is not None and value != '':
-                row[elm['xpath']] = ExportBuilder.convert_type(
-                    value, elm['type'])
+        for xpath, encoded_xpath in plan.encoded_fields:
+            if row.get(encoded_xpath):
+                row[xpath] = row.pop(encoded_xpath)
+
+        for xpath, choices in plan.select_multiples:
+            data = row.get(xpath)
+            selections = set(data.split()) if data else ()
+            if plan.binary_select_multiples:
+                for choice, name in choices:
+                    row[choice] = 1 if name in selections else 0
+            else:
+                for choice, name in choices:
+                    row[choice] = name in selections if selections else None
+
+        for xpath, gps_components in plan.gps_fields:
+            data = row.get(xpath)
+            if data:
+                row.update(zip(gps_components, data.split()))
+
+        # convert to native types, only if not empty
+        for xpath, data_type, convert in plan.converters:
+            value = row.get(xpath)
+            if value is not None and value != '':
+                row[xpath] = convert(value)
 
         return row
 
+    @classmethod
+    def convert_column(cls, values, data_type, convert):
+        """
+        convert applied to every one of values: int and decimal columns are
+        parsed by numpy in one go, which calls int() and float() on each
+        value, and value by value only when one of them does not parse.
+        """
+        dtype = cls.NUMPY_DTYPES.get(data_type)
+        if dtype is not None:
+            import numpy
+
+            try:
+                return numpy.array(values, dtype=object).astype(dtype).tolist()
+            except (ValueError, OverflowError):
+                pass
+
+        # other types are parsed once per distinct value
+        converted = {}
+        result = []
+        for value in values:
+            if not isinstance(value, six.string_types):
+                result.append(convert(value))
+            elif value in converted:
+                result.append(converted[value])
+            else:
+                result.append(converted.setdefault(value, convert(value)))
+        return result
+
+    def pre_process_columns(self, rows, section):
+        """
+        pre_process_row for every row of a section at once, on the
+        SectionRows of rows that were not pre processed: one column at a
+        time rather than one row at a time.
+        """
+        plan = self.plans[section['name']]
+
+        def has_data(value):
+            return value is not MISSING and value
+
+        for xpath, encoded_xpath in plan.encoded_fields:
+            encoded = rows.column(encoded_xpath)
+            if not any(has_data(value) for value in encoded):
+                continue
+            decoded = rows.column(xpath)
+            for i, value in enumerate(encoded):
+                if has_data(value):
+                    decoded[i] = value
+                    encoded[i] = MISSING
+            rows.set_column(xpath, decoded)
+            rows.set_column(encoded_xpath, encoded)
+
+        for xpath, choices in plan.select_multiples:
+            selections = [set(value.split()) if has_data(value) else ()
+                          for value in rows.column(xpath)]
+            for choice, name in choices:
+                if plan.binary_select_multiples:
+                    rows.set_column(choice, [1 if name in selected else 0
+                                             for selected in selections])
+                else:
+                    rows.set_column(choice, [name in selected if selected else None
+                                             for selected in selections])
+
+        for xpath, gps_components in plan.gps_fields:
+            data = rows.column(xpath)
+            if not any(has_data(value) for value in data):
+                continue
+            components = [rows.column(component) for component in gps_components]
+            for i, value in enumerate(data):
+                if has_data(value):
+                    for column, part in zip(components, value.split()):
+                        column[i] = part
+            for component, column in zip(gps_components, components):
+                rows.set_column(component, column)
+
+        # convert to native types, only if not empty
+        for xpath, data_type, convert in plan.converters:
+            if xpath not in rows.positions:
+                continue
+            values = rows.column(xpath)
+            present = [i for i, value in enumerate(values)
+                       if value is not MISSING and value is not None and value != '']
+            if not present:
+                continue
+            converted = self.convert_column([values[i] for i in present], data_type, convert)
+            for i, value in zip(present, converted):
+                values[i] = value
+            rows.set_column(xpath, values)
+
+        return rows
+
     def to_zipped_csv(self, path, data, *args):
         def write_row(row, csv_writer, fields):
             csv_writer.writerow(
@@ -492,8 +831,7 @@ class ExportBuilder(object):
 
         # write headers
         for section in self.sections:
-            fields = [element['title'] for element in section['elements']] \
-                     + self.EXTRA_FIELDS
+            fields = self.plans[section['name']].titles
             csv_defs[section['name']]['csv_writer'].writerow(
                 [f.encode('utf-8') for f in fields])
 
@@ -515,9 +853,7 @@ class ExportBuilder(object):
                 # get data for this section and write to csv
                 section_name = section['name']
                 csv_def = csv_defs[section_name]
-                fields = [
-                             element['xpath'] for element in
-                             section['elements']] + self.EXTRA_FIELDS
+                fields = self.plans[section_name].fields
                 csv_writer = csv_def['csv_writer']
                 # section name might not exist within the output, e.g. data was
                 # not provided for said repeat - write test to check this
@@ -545,6 +881,93 @@ class ExportBuilder(object):
         for section_name, csv_def in csv_defs.iteritems():
             csv_def['csv_file'].close()
 
+    def iter_zipped_csv(self, data):
+        """
+        Yields the bytes of a zip with one CSV per section, as to_zipped_csv
+        writes it, without temp files. The main section is streamed while the
+        submissions are read; repeat sections are kept deflated in memory
+        until it is complete.
+        """
+        class Lines(object):
+            def __init__(self):
+                self.lines = []
+
+            def write(self, line):
+                self.lines.append(line)
+
+            def pop(self):
+                data = b''.join(self.lines)
+                self.lines = []
+                return data
+
+        lines = Lines()
+        csv_writer = csv.writer(lines)
+        archive = ZipStream()
+        survey_name = self.survey.name
+        entries = {}
+        fields = {}
+
+        for section in self.sections:
+            section_name = section['name']
+            fields[section_name] = self.plans[section_name].fields
+            csv_writer.writerow(
+                [f.encode('utf-8') for f in self.plans[section_name].titles])
+            entries[section_name] = (DeflatedEntry(), [])
+            if section_name == survey_name:
+                main_header = lines.pop()
+            else:
+                entry, chunks = entries[section_name]
+                chunks.append(entry.compress(lines.pop()))
+
+        def main_section():
+            yield main_header
+
+            index = 1
+            indices = {}
+            for d in data:
+                output = dict_to_joined_export(d, index, indices,
+                                               survey_name)
+                if survey_name not in output:
+                    output[survey_name] = {}
+                output[survey_name][INDEX] = index
+                output[survey_name][PARENT_INDEX] = -1
+                for section in self.sections:
+                    section_name = section['name']
+                    row = output.get(section_name, None)
+                    if type(row) == dict:
+                        row = [row]
+                    for child_row in row or []:
+                        child_row = self.pre_process_row(child_row, section)
+                        csv_writer.writerow(
+                            [encode_if_str(child_row, field) for field in
+                             fields[section_name]])
+                        if section_name != survey_name:
+                            entry, chunks = entries[section_name]
+                            chunks.append(entry.compress(lines.pop()))
+                    if section_name == survey_name:
+                        yield lines.pop()
+                index += 1
+
+        def csv_name(section_name):
+            return "_".join(section_name.split("/")) + ".csv"
+
+        for chunk in archive.write_entry(csv_name(survey_name),
+                                         main_section()):
+            yield chunk
+
+        for section in self.sections:
+            section_name = section['name']
+            if section_name == survey_name:
+                continue
+            entry, chunks = entries.pop(section_name)
+            chunks.append(entry.flush())
+            for chunk in archive.write_deflated(csv_name(section_name),
+                                                entry, chunks):
+                yield chunk
+
+        for chunk in archive.finish():
+            yield chunk
+
     @classmethod
     def get_valid_sheet_name(cls, desired_name, existing_names):
         # a sheet name has to be <= 31 characters and not a duplicate of an
@@ -567,16 +990,11 @@ class ExportBuilder(object):
             i += 1
         return generated_name
 
-    def to_dict(self, data, *args, **kwargs):
-        work_sheets = {}
-        # map of section_names to generated_names
-        work_sheet_titles = {}
-        for section in self.sections:
-            section_name = section['name']
-            work_sheet_title = "_".join(section_name.split("/"))
-            work_sheet_titles[section_name] = work_sheet_title
-            work_sheets[section_name] = []
-
+    def iter_rows(self, data, pre_process=True):
+        """
+        Yields the section and row of every row the submissions in data
+        export to, in the order to_dict appends them.
+        """
         index = 1
         indices = {}
         survey_name = self.survey.name
@@ -593,21 +1011,36 @@ class ExportBuilder(object):
             for section in self.sections:
                 # get data for this section and write to xls
                 section_name = section['name']
-                fields = [
-                             element['xpath'] for element in
-                             section['elements']] + self.EXTRA_FIELDS
 
-                ws = work_sheets[section_name]
                 # section might not exist within the output, e.g. data was
                 # not provided for said repeat - write test to check this
                 row = output.get(section_name, None)
                 if type(row) == dict:
-                    ws.append(self.pre_process_row(row, section))
-                elif type(row) == list:
-                    for child_row in row:
-                        ws.append(self.pre_process_row(child_row, section))
+                    row = [row]
+                for child_row in row or []:
+                    if pre_process:
+                        child_row = self.pre_process_row(child_row, section)
+                    yield section, child_row
             index += 1
 
+    def to_dict(self, data, *args, **kwargs):
+        """
+        Returns the SectionRows of every section, keyed by section name. With
+        pre_process=False rows are left as they come out of
+        dict_to_joined_export; with columnar=True they are pre processed
+        by pre_process_columns once all of them have been added.
+        """
+        columnar = kwargs.get('columnar', False)
+        work_sheets = dict((section['name'], SectionRows(self.plans[section['name']].fields))
+                           for section in self.sections)
+        pre_process = kwargs.get('pre_process', True) and not columnar
+        for section, row in self.iter_rows(data, pre_process):
+            work_sheets[section['name']].append(row)
+
+        if columnar:
+            for section in self.sections:
+                self.pre_process_columns(work_sheets[section['name']], section)
+
         return work_sheets
 
     def to_xls_export(self, path, data, *args):
@@ -632,7 +1065,7 @@ class ExportBuilder(object):
         # write the headers
         for section in self.sections:
             section_name = section['name']
-            headers = [element['title'] for element in section['elements']] + self.EXTRA_FIELDS
+            headers = list(self.plans[section_name].titles)
 
             # get the worksheet
             ws = work_sheets[section_name]
@@ -654,9 +1087,7 @@ class ExportBuilder(object):
             for section in self.sections:
                 # get data for this section and write to xls
                 section_name = section['name']
-                fields = [
-                             element['xpath'] for element in
-                             section['elements']] + self.EXTRA_FIELDS
+                fields = self.plans[section_name].fields
 
                 ws = work_sheets[section_name]
                 # section might not exist within the output, e.g. data was
@@ -675,17 +1106,23 @@ class ExportBuilder(object):
 
         wb.save(filename=path)
 
-def generate_sections(form):
-    xform_survey = create_survey_element_from_dict(form)
-    group_delimiter = '/'
-    split_select_multiples = True
-    binary_select_multiples = False
+def build_export_builder(xform_survey, group_delimiter='/',
+                         split_select_multiples=True,
+                         binary_select_multiples=False):
     export_builder = ExportBuilder()
     export_builder.GROUP_DELIMITER = group_delimiter
     export_builder.SPLIT_SELECT_MULTIPLES = split_select_multiples
     export_builder.BINARY_SELECT_MULTIPLES = binary_select_multiples
     export_builder.set_survey(xform_survey)
 
+    return export_builder
+
+
+def generate_sections(form, xform_survey=None):
+    if not xform_survey:
+        xform_survey = create_survey_element_from_dict(form)
+    export_builder = build_export_builder(xform_survey)
+
     return dict([(s['name'], s['elements']) for s in export_builder.sections])
 
 
@@ -699,10 +1136,8 @@ def generate_export(form, data, group_delimiter='/',
     if not xform_survey:
         xform_survey = create_survey_element_from_dict(form)
 
-    export_builder = ExportBuilder()
-    export_builder.GROUP_DELIMITER = group_delimiter
-    export_builder.SPLIT_SELECT_MULTIPLES = split_select_multiples
-    export_builder.BINARY_SELECT_MULTIPLES = binary_select_multiples
-    export_builder.set_survey(xform_survey)
+    export_builder = build_export_builder(
+        xform_survey, group_delimiter, split_select_multiples,
+        binary_select_multiples)
 
-    return export_builder.to_dict(data)
\ No newline at end of file
+    return export_builder.to_dict(data)
@@ -0,0 +1,142 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+
+from six.moves.queue import Queue
+
+from .metrics import collect_timings
+
+JOBS_DIR = os.environ.get('KOBO_JOBS_DIR', os.path.join(tempfile.gettempdir(), 'kobotools-jobs'))
+
+# exports run at the same time by each web worker process
+EXPORT_WORKERS = int(os.environ.get('KOBO_EXPORT_WORKERS', 2))
+
+# seconds a finished job and its file are kept before being cleaned up
+JOB_TTL = 24 * 60 * 60
+
+JOB_ID_REGEX = re.compile(r'^[0-9a-f]{32}$')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobQueue(object):
+    """
+    Runs exports on a bounded pool of background threads. The state of every
+    job is kept as a JSON file next to its artifact in directory, so any web
+    worker process can report on or serve a job another one ran.
+    """
+
+    def __init__(self, directory=JOBS_DIR, workers=EXPORT_WORKERS):
+        self.directory = directory
+        self.workers = workers
+        self._queue = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _start(self):
+        # threads are started on first use rather than on import so that
+        # they belong to the gunicorn worker and not to the forking master
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _path(self, job_id, suffix):
+        return os.path.join(self.directory, job_id + suffix)
+
+    def _save(self, job):
+        path = self._path(job['id'], '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(job, f)
+        os.rename(path + '.tmp', path)
+
+    def submit(self, func, kind, suffix='.xlsx'):
+        """
+        Queues func, which is called with the path it must write its artifact
+        to, and returns the new job's description.
+        """
+        self.cleanup()
+        self._start()
+
+        job = {
+            'id': uuid.uuid4().hex,
+            'kind': kind,
+            'status': QUEUED,
+            'suffix': suffix,
+            'error': None,
+            'created': time.time(),
+            'finished': None,
+        }
+        self._save(job)
+        self._queue.put((job, func))
+
+        return job
+
+    def status(self, job_id):
+        """
+        Returns the description of a job, or None if there is no such job.
+        """
+        if not JOB_ID_REGEX.match(job_id):
+            return None
+
+        try:
+            with open(self._path(job_id, '.json')) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def result_path(self, job_id):
+        job = self.status(job_id)
+        if job is None or job['status'] != DONE:
+            return None
+        return self._path(job_id, job['suffix'])
+
+    def cleanup(self):
+        """
+        Removes the state and artifacts of jobs older than JOB_TTL.
+        """
+        limit = time.time() - JOB_TTL
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _work(self):
+        while True:
+            job, func = self._queue.get()
+            job['status'] = RUNNING
+            self._save(job)
+
+            try:
+                with collect_timings('{} {}'.format(job['kind'], job['id'])) as timings:
+                    func(self._path(job['id'], job['suffix']))
+                job['timings'] = timings
+                job['memory'] = timings.memory
+                job['status'] = DONE
+            except Exception as e:
+                traceback.print_exc()
+                job['status'] = FAILED
+                job['error'] = "{}".format(e)
+
+            job['finished'] = time.time()
+            self._save(job)
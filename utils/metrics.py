@@ -0,0 +1,245 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import os
+import resource
+import sys
+import threading
+import time
+
+# upper bounds, in seconds, of the stage duration histogram buckets
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+PREFIX = 'kobo'
+
+# with KOBO_TRACEMALLOC set, python allocations are traced and the top
+# TRACEMALLOC_TOP allocation sites are printed after every stage. This needs
+# tracemalloc, i.e. python 3: on python 2 KOBO_TRACEMALLOC does nothing
+TRACEMALLOC = bool(os.environ.get('KOBO_TRACEMALLOC'))
+TRACEMALLOC_TOP = 5
+
+# the HELP text of the gauges render writes
+GAUGE_HELP = {
+    'stage_rss_bytes': 'Most bytes resident when a stage ended.',
+    'stage_traced_peak_bytes': 'Peak bytes python allocated during a stage, with KOBO_TRACEMALLOC set. '
+                               'Python 3 only: python 2 has no tracemalloc and never reports it.',
+}
+
+
+def import_tracemalloc():
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    return tracemalloc
+
+
+tracemalloc = import_tracemalloc() if TRACEMALLOC else None
+if tracemalloc is not None and not tracemalloc.is_tracing():
+    tracemalloc.start()
+elif TRACEMALLOC and tracemalloc is None:
+    print("KOBO_TRACEMALLOC is ignored: python {} has no tracemalloc".format(sys.version.split()[0]))
+
+
+def peak_rss():
+    """
+    The most memory, in bytes, this process has had resident so far.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+def current_rss():
+    """
+    The memory, in bytes, this process has resident now, or peak_rss where
+    /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, ValueError, IndexError):
+        return peak_rss()
+
+
+class Registry(object):
+    """
+    Counters and per-stage duration histograms of one process, rendered in
+    the Prometheus text format by render.
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = OrderedDict()
+        self._stages = OrderedDict()
+        self._gauges = OrderedDict()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe_max(self, name, stage, value):
+        """
+        Keeps the largest value seen for stage in the gauge name.
+        """
+        with self._lock:
+            gauge = self._gauges.setdefault(name, OrderedDict())
+            gauge[stage] = max(gauge.get(stage, value), value)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            if stage not in self._stages:
+                self._stages[stage] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            histogram = self._stages[stage]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, value in self._counters.items():
+                metric = '{}_{}_total'.format(PREFIX, name)
+                lines.append('# TYPE {} counter'.format(metric))
+                lines.append('{} {}'.format(metric, value))
+
+            metric = '{}_stage_seconds'.format(PREFIX)
+            if self._stages:
+                lines.append('# TYPE {} histogram'.format(metric))
+            for stage, histogram in self._stages.items():
+                for bound, count in zip(self.buckets, histogram['buckets']):
+                    lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(metric, stage, bound, count))
+                lines.append('{}_bucket{{stage="{}",le="+Inf"}} {}'.format(metric, stage, histogram['count']))
+                lines.append('{}_sum{{stage="{}"}} {}'.format(metric, stage, histogram['sum']))
+                lines.append('{}_count{{stage="{}"}} {}'.format(metric, stage, histogram['count']))
+
+            for name, gauge in self._gauges.items():
+                metric = '{}_{}'.format(PREFIX, name)
+                if name in GAUGE_HELP:
+                    lines.append('# HELP {} {}'.format(metric, GAUGE_HELP[name]))
+                lines.append('# TYPE {} gauge'.format(metric))
+                for stage, value in gauge.items():
+                    lines.append('{}{{stage="{}"}} {}'.format(metric, stage, value))
+
+        metric = '{}_peak_rss_bytes'.format(PREFIX)
+        lines.append('# TYPE {} gauge'.format(metric))
+        lines.append('{} {}'.format(metric, peak_rss()))
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# the timings of the export running on this thread, see collect_timings
+local = threading.local()
+
+
+class ExportTimings(OrderedDict):
+    """
+    stage -> seconds spent in it by an export, with memory mapping stage ->
+    the most bytes resident when it ended and traced mapping stage -> the
+    peak bytes python allocated during it, when tracing.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ExportTimings, self).__init__(*args, **kwargs)
+        self.memory = OrderedDict()
+        self.traced = OrderedDict()
+
+    def summary(self):
+        parts = []
+        for stage, seconds in self.items():
+            part = '{} {:.2f}s {:.0f}MB'.format(stage, seconds, self.memory.get(stage, 0) / (1024 * 1024))
+            if stage in self.traced:
+                part += ' (traced {:.0f}MB)'.format(self.traced[stage] / (1024 * 1024))
+            parts.append(part)
+        peak = max([peak_rss()] + list(self.memory.values()))
+        parts.append('peak {:.0f}MB'.format(peak / (1024 * 1024)))
+        return ', '.join(parts)
+
+
+def current_timings():
+    return getattr(local, 'timings', None)
+
+
+def bind_timings(timings):
+    """
+    Makes the stages timed on this thread also count towards timings, e.g.
+    to report the work a background thread does for a request.
+    """
+    local.timings = timings
+
+
+@contextmanager
+def collect_timings(name=None):
+    """
+    Yields the ExportTimings of the stages run on this thread while the
+    block runs, for a Server-Timing header. With a name, they are printed
+    when the block ends.
+    """
+    previous = current_timings()
+    timings = ExportTimings()
+    local.timings = timings
+    try:
+        yield timings
+    finally:
+        local.timings = previous
+        if name is not None:
+            print("{}: {}".format(name, timings.summary()))
+
+
+def print_allocations(stage):
+    statistics = tracemalloc.take_snapshot().statistics('lineno')
+    print("top allocations after {}:".format(stage))
+    for statistic in statistics[:TRACEMALLOC_TOP]:
+        print("    {}".format(statistic))
+
+
+@contextmanager
+def timed(stage):
+    tracing = tracemalloc is not None and tracemalloc.is_tracing()
+    if tracing and hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+    started = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.time() - started
+        rss = current_rss()
+        registry.observe(stage, seconds)
+        registry.observe_max('stage_rss_bytes', stage, rss)
+
+        traced = None
+        if tracing:
+            traced = tracemalloc.get_traced_memory()[1]
+            registry.observe_max('stage_traced_peak_bytes', stage, traced)
+            print_allocations(stage)
+
+        timings = current_timings()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0) + seconds
+            timings.memory[stage] = max(timings.memory.get(stage, rss), rss)
+            if traced is not None:
+                timings.traced[stage] = max(timings.traced.get(stage, traced), traced)
+
+
+def count(name, value=1):
+    registry.increment(name, value)
+
+
+def server_timing(timings):
+    """
+    The value of a Server-Timing header for timings, in milliseconds.
+    """
+    return ', '.join('{};dur={:.1f}'.format(stage, seconds * 1000) for stage, seconds in timings.items())
+
+
+def render():
+    return registry.render()
@@ -0,0 +1,215 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+
+import json
+import os
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+
+from .formhub_utils import ID, UUID, SUBMISSION_TIME, DELETEDAT
+
+# when a submission was last edited, in the same format as _submission_time
+LAST_EDITED = u"_last_edited"
+
+SUBMISSION_STORE_PATH = os.environ.get(
+    'KOBO_SUBMISSION_STORE',
+    os.path.join(tempfile.gettempdir(), 'kobotools-submissions.sqlite3'))
+
+# submissions written per executemany call while saving
+SAVE_BATCH_SIZE = 500
+
+
+class SubmissionStore(object):
+    """
+    Local SQLite copy of the submissions of every form exported so far,
+    keyed by form pk and submission _id, so exports only have to fetch
+    submissions that arrived or were edited since the last sync.
+    """
+
+    def __init__(self, path=SUBMISSION_STORE_PATH):
+        self.path = path
+        connection = self._connect()
+        try:
+            # lets exports read the store while another form is syncing
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS submissions ("
+                " form_pk INTEGER NOT NULL,"
+                " id INTEGER NOT NULL,"
+                " uuid TEXT,"
+                " submission_time TEXT,"
+                " body TEXT NOT NULL,"
+                " PRIMARY KEY (form_pk, id))")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sync_state ("
+                " form_pk INTEGER PRIMARY KEY,"
+                " last_id INTEGER NOT NULL,"
+                " last_submission_time TEXT,"
+                " synced_at TEXT NOT NULL)")
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(sync_state)")]
+            if 'reconciled_at' not in columns:
+                # stores created before deletions were reconciled
+                connection.execute("ALTER TABLE sync_state ADD COLUMN reconciled_at TEXT")
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def last_id(self, pk):
+        """
+        Returns the highest submission _id stored for the form, 0 if none.
+        """
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                "SELECT last_id FROM sync_state WHERE form_pk = ?", (pk,)).fetchone()
+        finally:
+            connection.close()
+
+        return row[0] if row else 0
+
+    def last_modified(self, pk):
+        """
+        Returns the latest _submission_time or _last_edited stored for the
+        form, None if nothing is stored. Edits made after it have a later
+        _last_edited.
+        """
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                "SELECT last_submission_time FROM sync_state WHERE form_pk = ?", (pk,)).fetchone()
+        finally:
+            connection.close()
+
+        return row[0] if row else None
+
+    def needs_reconcile(self, pk, interval):
+        """
+        Whether the form's stored _ids were last compared with the upstream
+        ones (see reconcile) more than interval seconds ago, or never.
+        """
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                "SELECT reconciled_at FROM sync_state WHERE form_pk = ?", (pk,)).fetchone()
+        finally:
+            connection.close()
+
+        if not row or not row[0]:
+            return True
+        return row[0] < (datetime.utcnow() - timedelta(seconds=interval)).isoformat()
+
+    def reconcile(self, pk, ids):
+        """
+        Removes the stored submissions of a form whose _id is not in ids, the
+        _ids the form has upstream, i.e. those deleted since they were stored.
+        Returns how many were removed.
+        """
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("CREATE TEMP TABLE IF NOT EXISTS upstream_ids (id INTEGER PRIMARY KEY)")
+                connection.execute("DELETE FROM upstream_ids")
+                connection.executemany("INSERT OR IGNORE INTO upstream_ids VALUES (?)", ((i,) for i in ids))
+                removed = connection.execute(
+                    "DELETE FROM submissions WHERE form_pk = ? AND id NOT IN (SELECT id FROM upstream_ids)",
+                    (pk,)).rowcount
+                connection.execute(
+                    "UPDATE sync_state SET reconciled_at = ? WHERE form_pk = ?",
+                    (datetime.utcnow().isoformat(), pk))
+        finally:
+            connection.close()
+
+        return removed
+
+    def size(self, pk):
+        """
+        Returns the number of bytes of JSON stored for the form's submissions.
+        """
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                "SELECT COALESCE(SUM(LENGTH(body)), 0) FROM submissions WHERE form_pk = ?", (pk,)).fetchone()
+        finally:
+            connection.close()
+
+        return row[0]
+
+    def save(self, pk, submissions):
+        """
+        Inserts or replaces submissions of a form and removes those that
+        carry a _deleted_at marker. Submissions are expected in _id order and
+        are committed in batches along with the highest _id and the latest
+        submission or edit time seen, so no lock is held while they are
+        being fetched and an interrupted sync resumes after the last
+        committed batch.
+        """
+        connection = self._connect()
+        try:
+            state = connection.execute(
+                "SELECT last_id, last_submission_time FROM sync_state WHERE form_pk = ?",
+                (pk,)).fetchone()
+            last_id, last_submission_time = state or (0, None)
+
+            batch = []
+            deleted = []
+            for submission in submissions:
+                last_id = max(last_id, submission[ID])
+                for modified in (submission.get(SUBMISSION_TIME), submission.get(LAST_EDITED)):
+                    if modified and modified > (last_submission_time or ''):
+                        last_submission_time = modified
+
+                if submission.get(DELETEDAT):
+                    deleted.append((pk, submission[ID]))
+                else:
+                    batch.append((pk, submission[ID], submission.get(UUID),
+                                  submission.get(SUBMISSION_TIME), json.dumps(submission)))
+
+                if len(batch) + len(deleted) >= SAVE_BATCH_SIZE:
+                    self._commit(connection, pk, batch, deleted, last_id, last_submission_time)
+                    batch = []
+                    deleted = []
+
+            self._commit(connection, pk, batch, deleted, last_id, last_submission_time)
+        finally:
+            connection.close()
+
+    def _commit(self, connection, pk, batch, deleted, last_id, last_submission_time):
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO submissions VALUES (?, ?, ?, ?, ?)", batch)
+            connection.executemany(
+                "DELETE FROM submissions WHERE form_pk = ? AND id = ?", deleted)
+            connection.execute(
+                "INSERT OR REPLACE INTO sync_state"
+                " (form_pk, last_id, last_submission_time, synced_at, reconciled_at)"
+                " VALUES (?, ?, ?, ?, (SELECT reconciled_at FROM sync_state WHERE form_pk = ?))",
+                (pk, last_id, last_submission_time, datetime.utcnow().isoformat(), pk))
+
+    def clear(self, pk):
+        """
+        Forgets every stored submission of a form so the next sync fetches
+        its whole history again.
+        """
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("DELETE FROM submissions WHERE form_pk = ?", (pk,))
+                connection.execute("DELETE FROM sync_state WHERE form_pk = ?", (pk,))
+        finally:
+            connection.close()
+
+    def iter_submissions(self, pk):
+        """
+        Yields the stored submissions of a form in _id order.
+        """
+        connection = self._connect()
+        try:
+            cursor = connection.execute(
+                "SELECT body FROM submissions WHERE form_pk = ? ORDER BY id", (pk,))
+            for body, in cursor:
+                yield json.loads(body)
+        finally:
+            connection.close()
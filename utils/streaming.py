@@ -0,0 +1,276 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+
+import re
+import struct
+import time
+import zlib
+from datetime import date, datetime
+
+import six
+
+from xml.sax.saxutils import escape, quoteattr
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+ZIP_MIMETYPE = 'application/zip'
+
+# bytes of compressed output gathered before they are handed to the client
+CHUNK_SIZE = 64 * 1024
+
+ZIP32_LIMIT = 0xFFFFFFFF
+
+# characters that are not allowed anywhere in an XML document
+INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+class DeflatedEntry(object):
+    """
+    The content of a zip entry, deflated as it is written, with the running
+    checksum and sizes its zip headers need.
+    """
+
+    def __init__(self, compression_level=6):
+        self._compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -15)
+        self._crc = 0
+        self.size = 0
+        self.compressed_size = 0
+
+    @property
+    def crc(self):
+        return self._crc & 0xFFFFFFFF
+
+    def compress(self, data):
+        if not data:
+            return b''
+        self._crc = zlib.crc32(data, self._crc)
+        self.size += len(data)
+        compressed = self._compressor.compress(data)
+        self.compressed_size += len(compressed)
+        return compressed
+
+    def flush(self):
+        compressed = self._compressor.flush()
+        self.compressed_size += len(compressed)
+        return compressed
+
+
+class ZipStream(object):
+    """
+    Produces a zip archive as a sequence of byte strings without ever seeking
+    back, so it can be sent to a client while it is being written. Entry
+    sizes and checksums go in data descriptors after each entry's content.
+    """
+
+    def __init__(self, compression_level=6):
+        self.compression_level = compression_level
+        self._entries = []
+        self._offset = 0
+
+    def _dos_timestamp(self):
+        t = time.localtime()
+        dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+        dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+        return dos_time, dos_date
+
+    def write_entry(self, name, chunks):
+        """
+        Yields the bytes of an entry called name whose content is the
+        concatenation of the byte strings in chunks, compressed as they come.
+        """
+        entry = DeflatedEntry(self.compression_level)
+
+        def compressed():
+            buffered = []
+            buffered_size = 0
+            for chunk in chunks:
+                data = entry.compress(chunk)
+                if data:
+                    buffered.append(data)
+                    buffered_size += len(data)
+                if buffered_size >= CHUNK_SIZE:
+                    yield b''.join(buffered)
+                    buffered = []
+                    buffered_size = 0
+            yield b''.join(buffered) + entry.flush()
+
+        return self.write_deflated(name, entry, compressed())
+
+    def write_deflated(self, name, entry, chunks):
+        """
+        Yields the bytes of an entry called name whose content was compressed
+        by the DeflatedEntry entry into the byte strings chunks. entry must be
+        flushed by the time chunks is exhausted.
+        """
+        name = name.encode('utf-8')
+        offset = self._offset
+        dos_time, dos_date = self._dos_timestamp()
+
+        # bit 3: sizes follow in a data descriptor, bit 11: utf-8 name
+        flags = 0x08 | 0x800
+        header = struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 20, flags, zlib.DEFLATED,
+            dos_time, dos_date, 0, 0, 0, len(name), 0) + name
+        self._offset += len(header)
+        yield header
+
+        for data in chunks:
+            if data:
+                self._offset += len(data)
+                yield data
+
+        if entry.size > ZIP32_LIMIT or entry.compressed_size > ZIP32_LIMIT or self._offset > ZIP32_LIMIT:
+            raise ValueError("{} is too large for a zip archive without zip64".format(name))
+
+        descriptor = struct.pack('<IIII', 0x08074b50, entry.crc, entry.compressed_size, entry.size)
+        self._offset += len(descriptor)
+        yield descriptor
+
+        self._entries.append(
+            (name, flags, dos_time, dos_date, entry.crc, entry.compressed_size, entry.size, offset))
+
+    def finish(self):
+        """
+        Yields the central directory, which closes the archive.
+        """
+        directory = []
+        for name, flags, dos_time, dos_date, crc, compressed_size, size, offset in self._entries:
+            directory.append(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, flags, zlib.DEFLATED,
+                dos_time, dos_date, crc, compressed_size, size, len(name),
+                0, 0, 0, 0, 0, offset) + name)
+        directory = b''.join(directory)
+
+        end = struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, len(self._entries), len(self._entries),
+            len(directory), self._offset, 0)
+        self._offset += len(directory) + len(end)
+        yield directory + end
+
+
+def column_letter(index):
+    """
+    Excel column name of the zero based column index, e.g. 27 -> 'AB'.
+    """
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def xlsx_cell(ref, value):
+    if value is None or value != value:  # NaN != NaN
+        return ''
+
+    if isinstance(value, bool):
+        return '<c r="{}" t="b"><v>{}</v></c>'.format(ref, int(value))
+
+    if isinstance(value, six.integer_types):
+        return '<c r="{}"><v>{}</v></c>'.format(ref, int(value))
+
+    if isinstance(value, float) and abs(value) != float('inf'):
+        return '<c r="{}"><v>{}</v></c>'.format(ref, repr(value))
+
+    if isinstance(value, (datetime, date)):
+        value = value.isoformat()
+    elif isinstance(value, six.binary_type):
+        value = value.decode('utf-8')
+    elif not isinstance(value, six.string_types):
+        value = six.text_type(value)
+
+    value = escape(INVALID_XML_CHARS.sub('', value))
+    return '<c r="{}" t="inlineStr"><is><t xml:space="preserve">{}</t></is></c>'.format(ref, value)
+
+
+def iter_sheet_xml(rows):
+    """
+    Yields the worksheet XML for rows (lists of cell values), one encoded row
+    at a time. Strings are written inline so no shared string table is kept.
+    """
+    yield ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+           '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+           '<sheetData>').encode('utf-8')
+
+    letters = []
+    for r, row in enumerate(rows, start=1):
+        while len(letters) < len(row):
+            letters.append(column_letter(len(letters)))
+        cells = ''.join(xlsx_cell('{}{}'.format(letters[c], r), value) for c, value in enumerate(row))
+        yield '<row r="{}">{}</row>'.format(r, cells).encode('utf-8')
+
+    yield '</sheetData></worksheet>'.encode('utf-8')
+
+
+def iter_xlsx(sheets):
+    """
+    Yields the bytes of an XLSX workbook built from sheets, an iterable of
+    (title, rows) pairs consumed one after the other. Only the row being
+    written is held in memory.
+    """
+    archive = ZipStream()
+    titles = []
+
+    for title, rows in sheets:
+        titles.append(title)
+        for data in archive.write_entry('xl/worksheets/sheet{}.xml'.format(len(titles)), iter_sheet_xml(rows)):
+            yield data
+
+    numbers = range(1, len(titles) + 1)
+    parts = [
+        ('[Content_Types].xml',
+         '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+         '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+         '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+         '<Default Extension="xml" ContentType="application/xml"/>'
+         '<Override PartName="/xl/workbook.xml" '
+         'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+         '<Override PartName="/xl/styles.xml" '
+         'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>' +
+         ''.join('<Override PartName="/xl/worksheets/sheet{}.xml" '
+                 'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                 .format(n) for n in numbers) +
+         '</Types>'),
+        ('_rels/.rels',
+         '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+         '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+         '<Relationship Id="rId1" '
+         'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+         'Target="xl/workbook.xml"/>'
+         '</Relationships>'),
+        ('xl/workbook.xml',
+         '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+         '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+         'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+         '<sheets>' +
+         ''.join('<sheet name={} sheetId="{}" r:id="rId{}"/>'.format(quoteattr(title), n, n)
+                 for n, title in zip(numbers, titles)) +
+         '</sheets></workbook>'),
+        ('xl/_rels/workbook.xml.rels',
+         '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+         '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">' +
+         ''.join('<Relationship Id="rId{}" '
+                 'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+                 'Target="worksheets/sheet{}.xml"/>'.format(n, n) for n in numbers) +
+         '<Relationship Id="rId{}" '
+         'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+         'Target="styles.xml"/>'.format(len(titles) + 1) +
+         '</Relationships>'),
+        ('xl/styles.xml',
+         '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+         '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+         '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+         '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+         '<fill><patternFill patternType="gray125"/></fill></fills>'
+         '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+         '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+         '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+         '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+         '</styleSheet>'),
+    ]
+
+    for name, xml in parts:
+        for data in archive.write_entry(name, [xml.encode('utf-8')]):
+            yield data
+
+    for data in archive.finish():
+        yield data
@@ -0,0 +1,178 @@
+from __future__ import absolute_import, unicode_literals, division, print_function
+
+import binascii
+import hashlib
+import hmac
+import os
+import sqlite3
+import time
+
+from .cache import LRUCache
+
+# seconds an API token is reused for the same credentials or session
+TOKEN_TTL = int(os.environ.get('KOBO_TOKEN_TTL', 60 * 60))
+
+# tokens kept in memory by each process
+TOKEN_CACHE_SIZE = 1024
+
+# optional SQLite file shared by every web worker process, so a login or a
+# session started on one worker is known to the others
+TOKEN_STORE_PATH = os.environ.get('KOBO_TOKEN_STORE')
+
+# key used to hash credentials and sign session cookies. Without
+# KOBO_SECRET_KEY one is generated once into SECRET_KEY_PATH, so every
+# worker process on the host agrees on it. The file lives in a directory of
+# the user running the app, not in the shared temporary directory where
+# another user could create it first
+SECRET_KEY_PATH = os.environ.get(
+    'KOBO_SECRET_KEY_FILE',
+    os.path.join(os.path.expanduser('~'), '.kobotools', 'secret-key'))
+
+
+def check_private(fd, path):
+    """
+    Raises unless the open file fd is owned by this process's user and
+    nobody else can read or write it.
+    """
+    stat = os.fstat(fd)
+    if stat.st_uid != os.getuid():
+        raise Exception("Secret key file {} is not owned by this user".format(path))
+    if stat.st_mode & 0o077:
+        raise Exception("Secret key file {} is accessible to other users, it should be mode 0600".format(path))
+
+
+def load_secret_key(path=SECRET_KEY_PATH):
+    if os.environ.get('KOBO_SECRET_KEY'):
+        return os.environ['KOBO_SECRET_KEY'].encode('utf-8')
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError:
+            # another process created it first
+            pass
+
+    # a symlink planted at path is not followed
+    nofollow = getattr(os, 'O_NOFOLLOW', 0)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | nofollow, 0o600)
+    except OSError:
+        # another process created it first
+        pass
+    else:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(binascii.hexlify(os.urandom(32)))
+
+    for attempt in range(50):
+        fd = os.open(path, os.O_RDONLY | nofollow)
+        with os.fdopen(fd, 'rb') as f:
+            check_private(fd, path)
+            key = f.read().strip()
+        if key:
+            return key
+        time.sleep(0.01)
+
+    raise Exception("Empty secret key file {}".format(path))
+
+
+SECRET_KEY = load_secret_key()
+
+
+def credentials_key(username, password):
+    """
+    Returns the cache key of a username and password: an HMAC of both under
+    SECRET_KEY, so the credentials themselves are never stored.
+    """
+    message = "{}\0{}".format(username, password).encode('utf-8')
+    return 'credentials:' + hmac.new(SECRET_KEY, message, hashlib.sha256).hexdigest()
+
+
+def new_session_key():
+    return 'session:' + binascii.hexlify(os.urandom(16)).decode('ascii')
+
+
+class TokenCache(object):
+    """
+    Maps keys (hashed credentials or session ids) to API tokens for
+    ttl seconds, in a per-process LRU in front of an optional SQLite table.
+    """
+
+    def __init__(self, ttl=TOKEN_TTL, path=TOKEN_STORE_PATH, maxsize=TOKEN_CACHE_SIZE):
+        self.ttl = ttl
+        self.path = path
+        self._memory = LRUCache(maxsize)
+
+        if self.path:
+            # the file holds API tokens, keep it private to this user
+            os.close(os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o600))
+            connection = self._connect()
+            try:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS tokens ("
+                    " key TEXT PRIMARY KEY,"
+                    " token TEXT NOT NULL,"
+                    " expires REAL NOT NULL)")
+                connection.commit()
+            finally:
+                connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def get(self, key):
+        """
+        Returns the token stored under key, None if there is none or it
+        expired.
+        """
+        now = time.time()
+        cached = self._memory.get(key)
+        if cached is not None:
+            token, expires = cached
+            if expires > now:
+                return token
+            self._memory.pop(key)
+
+        if not self.path:
+            return None
+
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                "SELECT token, expires FROM tokens WHERE key = ?", (key,)).fetchone()
+        finally:
+            connection.close()
+
+        if row is None or row[1] <= now:
+            return None
+
+        self._memory.put(key, row)
+        return row[0]
+
+    def put(self, key, token):
+        expires = time.time() + self.ttl
+        self._memory.put(key, (token, expires))
+
+        if not self.path:
+            return
+
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)", (key, token, expires))
+                connection.execute("DELETE FROM tokens WHERE expires <= ?", (time.time(),))
+        finally:
+            connection.close()
+
+    def pop(self, key):
+        self._memory.pop(key)
+
+        if not self.path:
+            return
+
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("DELETE FROM tokens WHERE key = ?", (key,))
+        finally:
+            connection.close()
@@ -2,16 +2,80 @@ from __future__ import absolute_import, unicode_literals, division, print_functi
 
 __author__ = 'reyrodrigues'
 
-from .formhub_utils import generate_export, generate_sections
+from . import client
+from .cache import LRUCache
+from .metrics import bind_timings, count, current_rss, current_timings, timed
+from .formhub_utils import ExportBuilder, SectionRows, build_export_builder, INDEX, PARENT_INDEX, PARENT_TABLE_NAME
+from .store import SubmissionStore
+from .streaming import ZipStream, iter_xlsx
 from pyxform import create_survey_element_from_dict
-import requests
-from collections import OrderedDict
-import math
-
-ONA_API_URL = "https://kc.humanitarianresponse.info/api/v1"
+from collections import Counter, OrderedDict, namedtuple
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter
+from tempfile import TemporaryFile, mkdtemp, mkstemp
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+from six.moves import cPickle as pickle
+from six.moves.queue import Full, Queue
+import threading
+import time
+
+ONA_API_URL = os.environ.get('KOBO_API_URL', "https://kc.humanitarianresponse.info/api/v1")
+
+# number of submissions requested from /data/{pk} per call
+SUBMISSIONS_PAGE_SIZE = 1000
+
+# seconds between comparisons of the _ids stored for a form with those it
+# has upstream, which is how deleted submissions leave the store
+RECONCILE_INTERVAL = int(os.environ.get('KOBO_RECONCILE_INTERVAL', 15 * 60))
+
+# seconds a prefetch thread waits on a full queue before checking whether
+# its consumer has gone away
+PREFETCH_POLL_SECONDS = 1
+
+# bytes read at a time when copying files into a response
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# number of compiled form versions kept in memory
+FORM_CACHE_SIZE = 32
+
+# seconds the forms list of a token is served from memory before it is
+# revalidated with the API, and number of tokens it is kept for
+FORMS_CACHE_TTL = int(os.environ.get('KOBO_FORMS_CACHE_TTL', 60))
+FORMS_CACHE_SIZE = 256
+
+# forms exported at the same time by a batch export
+BATCH_WORKERS = int(os.environ.get('KOBO_BATCH_WORKERS', 4))
+
+# processes converting submissions into section rows, 0 or 1 to convert
+# them in the calling process
+TRANSFORM_PROCESSES = int(os.environ.get('KOBO_TRANSFORM_PROCESSES', 0))
+
+# submissions sent to a transform process at a time
+SHARD_SIZE = 2000
+
+# bytes of memory a process may reach while exporting a form, 0 for no
+# limit. Spreadsheet exports expected to go over it spill their rows to
+# temporary files instead of keeping them in memory
+MEMORY_BUDGET = int(os.environ.get('KOBO_MEMORY_BUDGET', 0))
+
+# estimated bytes of memory an in memory export uses per byte of stored
+# submission JSON: the parsed submissions, the section rows and the frames
+MEMORY_PER_JSON_BYTE = 16
 
 
 def title_dictionary(children, parent_index=None):
+    """
+    Returns (name, title) pairs for the labelled questions and groups in
+    children and their groups, in the order of the form. A title is the
+    label prefixed by the position of the item, e.g. "02.01 Name".
+    """
     return_items = []
     for index, item in enumerate(children):
         if parent_index:
@@ -28,184 +92,819 @@ def title_dictionary(children, parent_index=None):
         if 'children' in item and item['type'] == 'group':
             return_items += title_dictionary(item['children'], name_index)
 
-    return set(return_items)
+    return return_items
+
+
+def parents_first(parents):
+    """
+    Orders sheet names so that every sheet comes after its parent sheet.
+    parents maps each sheet name to the name in its rows' _parent_table_name.
+    """
+    ordered = []
+    visiting = set()
+
+    def visit(key):
+        if key in ordered or key in visiting or key not in parents:
+            return
+        visiting.add(key)
+        visit(parents[key])
+        ordered.append(key)
+
+    for key in parents.keys():
+        visit(key)
+
+    return ordered
+
+
+def join_rows(rows, indexes):
+    """
+    Adds the columns of each row's parent row, prefixed with the parent
+    table name, looking the parent up in indexes (table -> _index -> row).
+    """
+    for r in rows:
+        parent_table = r.get('_parent_table_name')
+        parent_index = r.get('_parent_index')
+
+        if parent_table in indexes:
+            parent_row = indexes[parent_table].get(parent_index)
+            if parent_row:
+                r.update([(parent_table + '/' + k, parent_row[k]) for k in parent_row.keys()])
+
+        yield r
+
+
+def stored_sheet(compiled, data, section_name):
+    """
+    Returns the columns of a section exported from the submission store and
+    a generator over its rows as OrderedDicts in that column order.
+    """
+    columns = compiled.export_builder.plans[section_name].fields
+
+    def iter_rows():
+        for values in data[section_name].iter_values(columns):
+            yield OrderedDict(zip(columns, values))
+
+    return columns, iter_rows()
+
+
+def spilled_sheet(compiled, sections, section_name):
+    """
+    stored_sheet for a SpilledSection, reading its rows back from disk.
+    """
+    columns = compiled.export_builder.plans[section_name].fields
+
+    def iter_rows():
+        for row in sections[section_name]:
+            yield OrderedDict((col, row.get(col)) for col in columns)
+
+    return columns, iter_rows()
+
+
+def write_joined(sheets, output):
+    """
+    Writes every sheet to the workbook at output.name with the columns of
+    its parent rows appended. sheets maps each sheet name to a callable
+    returning the sheet's headers and a fresh iterator over its rows.
+    """
+    import xlsxwriter
+
+    # _parent_table_name is the same for every row of a sheet, so the
+    # first row is enough to know how sheets nest
+    parents = OrderedDict()
+    for name, read in sheets.iteritems():
+        parents[name] = None
+        for row in read()[1]:
+            parents[name] = row.get('_parent_table_name')
+            break
+
+    w = xlsxwriter.Workbook(output.name, {'constant_memory': True})
+    worksheets = {}
+    for name in sheets.keys():
+        title = ExportBuilder.get_valid_sheet_name("_".join(name.split("/")), [ws.name for ws in worksheets.values()])
+        worksheets[name] = w.add_worksheet(title)
+
+    # only sheets that other sheets join against are kept in memory, as an
+    # _index -> row lookup; every other sheet streams straight through.
+    # Parents are joined before their children so that a child row also
+    # picks up the columns its parent inherited from the grandparent.
+    indexes = {}
+    joined_against = set(parents.values())
+    for name in parents_first(parents):
+        ws = worksheets[name]
+        index = indexes[name] = {} if name in joined_against else None
+        sheet_headers, rows = sheets[name]()
+
+        columns = None
+        for i, row in enumerate(join_rows(rows, indexes), start=1):
+            if columns is None:
+                columns = list(row.keys())
+                ws.write_row(0, 0, columns)
+
+            ws.write_row(i, 0, [row.get(col) for col in columns])
+
+            if index is not None:
+                index.setdefault(row.get('_index'), row)
+
+        if columns is None:
+            ws.write_row(0, 0, sheet_headers)
+
+    w.close()
+    output.flush()
 
 
 def generate_joined(pk, token, output):
-    from tempfile import NamedTemporaryFile
-    import xlrd
-    import subprocess, urllib
+    """
+    Writes the joined export of a form, built from the local submission
+    store, to output.
+    """
+    compiled = compile_form(pk, token)
+    sync_submissions(pk, token)
+
+    if exceeds_memory_budget(pk, token, synced=True):
+        # only the sections other sections join against are then held in
+        # memory, by write_joined
+        with timed('spill'):
+            sections = spill_sections(compiled, submission_store.iter_submissions(pk), label=False)
+        try:
+            sheets = OrderedDict(
+                (s['name'], partial(spilled_sheet, compiled, sections, s['name']))
+                for s in compiled.export_builder.sections)
+            with timed('write'):
+                write_joined(sheets, output)
+        finally:
+            close_sections(sections)
+        return
+
+    with timed('transform'):
+        data = compiled.export_builder.to_dict(submission_store.iter_submissions(pk))
+
+    sheets = OrderedDict(
+        (s['name'], partial(stored_sheet, compiled, data, s['name'])) for s in compiled.export_builder.sections)
+    with timed('write'):
+        write_joined(sheets, output)
+
+
+def iter_submission_pages(pk, token, page_size=SUBMISSIONS_PAGE_SIZE, query=None, fields=None):
+    """
+    Yields the submissions of a form in lists of at most page_size items,
+    paging through /data/{pk} with start/limit ordered by _id. query is an
+    optional mongo-style filter, e.g. {"_id": {"$gt": 10}}, and fields an
+    optional list of the only keys to return, e.g. ["_id"].
+    """
     ona_api_url = ONA_API_URL
     headers = {"Authorization": "Token {}".format(token)}
 
     if ona_api_url.endswith('/'):
         ona_api_url = ona_api_url[:-1]
 
-    r = requests.get("{}/forms/{}.xlsx".format(ona_api_url, pk), headers=headers, stream=True)
-    content = {}
-    with NamedTemporaryFile(suffix='.xlsx') as temp:
-        b =r.raw.read()
-        temp.write(b)
-        temp.flush()
-        temp.delete = True
-
-        rd = xlrd.open_workbook(temp.name)
-
-
-    for name in rd.sheet_names():
-        content[name] = []
-        sheet = rd.sheet_by_name(name)
-        headers = [sheet.cell_value(0, c) for c in xrange(0, sheet.ncols)]
-        for row in range(1, sheet.nrows):
-            values = [sheet.cell_value(row, c) for c in xrange(0, sheet.ncols)]
-            content[name].append(OrderedDict(zip(headers, values)))
-
-    for key, value in content.iteritems():
-        if value:
-            # _parent_table_name	_parent_index
-            if '_parent_table_name' in value[0]:
-                for r in value:
-                    parent_table = r['_parent_table_name']
-                    parent_index = r['_parent_index']
-
-                    if parent_table in content:
-                        parent_row = [pr for pr in content[parent_table] if parent_index == pr['_index']]
-                        if parent_row:
-                            parent_row = parent_row[0]
-                            key_dictionary = [(parent_table + '/' + k, parent_row[k]) for k in parent_row.keys()]
-                            r.update(dict(key_dictionary))
+    start = 0
+    while True:
+        params = {'start': start, 'limit': page_size, 'sort': '{"_id": 1}'}
+        if query:
+            params['query'] = json.dumps(query)
+        if fields:
+            params['fields'] = json.dumps(fields)
+        # submissions are decoded as the response arrives, without holding
+        # its whole text; an error object raises
+        with timed('fetch'):
+            response = client.get("{}/data/{}".format(ona_api_url, pk), headers=headers, params=params, stream=True)
+            try:
+                page = list(client.iter_json_items(response))
+            finally:
+                response.close()
+
+        count('submissions_fetched', len(page))
+
+        if page:
+            yield page
+
+        if len(page) < page_size:
+            break
+
+        start += len(page)
+
+
+def prefetch(iterable, depth=1):
+    """
+    Iterates over iterable in a background thread, keeping up to depth items
+    ready so the consumer overlaps with the producer (e.g. network fetches).
+    If the consumer stops early, the thread stops too and closes iterable.
+    """
+    queue = Queue(maxsize=depth)
+    done = object()
+    failure = []
+    stopped = threading.Event()
+    timings = current_timings()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=PREFETCH_POLL_SECONDS)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        bind_timings(timings)
+        try:
+            for item in iterable:
+                if not put(item):
+                    break
+        except Exception as e:
+            failure.append(e)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+        put(done)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item = queue.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        stopped.set()
+
+    if failure:
+        raise failure[0]
+
+
+def iter_submissions(pk, token, page_size=SUBMISSIONS_PAGE_SIZE, query=None, fields=None):
+    """
+    Yields the submissions of a form one at a time; the next page is fetched
+    while the current one is being processed.
+    """
+    for page in prefetch(iter_submission_pages(pk, token, page_size, query, fields)):
+        for submission in page:
+            yield submission
+
+
+submission_store = SubmissionStore()
+
+
+def sync_submissions(pk, token):
+    """
+    Brings the local store up to date with the form: fetches the
+    submissions with an _id above the highest one already stored and those
+    edited since the last sync, and every RECONCILE_INTERVAL seconds drops
+    the stored submissions the form no longer has.
+    """
+    with timed('sync'):
+        # read before saving new submissions, whose times are later than
+        # edits made before they arrived
+        modified = submission_store.last_modified(pk)
+
+        query = {"_id": {"$gt": submission_store.last_id(pk)}}
+        submission_store.save(pk, iter_submissions(pk, token, query=query))
+
+        if modified:
+            query = {"_last_edited": {"$gte": modified}}
+            submission_store.save(pk, iter_submissions(pk, token, query=query))
+
+        if submission_store.needs_reconcile(pk, RECONCILE_INTERVAL):
+            ids = [s['_id'] for s in iter_submissions(pk, token, fields=['_id'])]
+            count('deleted_submissions', submission_store.reconcile(pk, ids))
+
+
+def choice_label(label):
+    return label['English'] if isinstance(label, dict) else label
+
+
+def compile_choice_labels(sections, xform_survey):
+    """
+    Maps the xpath of every select/select1 question to a dictionary of
+    choice name -> (position, label), so translating a value is a lookup.
+    Choices listed on the question win over those of its itemset.
+    """
+    choice_labels = {}
+    for elements in sections.values():
+        for s in elements:
+            if s['type'] not in ['select', 'select1']:
+                continue
+
+            choices = [l for l in s.get('children', []) if isinstance(l, dict)]
+            if s.get('itemset'):
+                choices = [l for l in xform_survey.choices.get(s['itemset']) or [] if isinstance(l, dict)] + choices
+
+            lookup = choice_labels[s['xpath']] = {}
+            for position, l in enumerate(choices):
+                lookup[l['name']] = (position, choice_label(l['label']))
+
+    return choice_labels
+
+
+def translate_choice(s, choices, name):
+    """
+    Returns the label(s) of the choice(s) in the answer name to the select
+    question s, or name itself when they are not in choices.
+    """
+    if s['type'] == 'select1':
+        if name in choices:
+            return choices[name][1]
+        elif not s.get('itemset'):
+            print(name, " not found")
+    elif name:
+        options = sorted(choices[n] for n in set(name.split(' ')) if n in choices)
+        if options:
+            return ", ".join(label for order, label in options)
+
+    return name
+
+
+def column_titles(definition):
+    """
+    Maps question names to their column titles in the order of the form.
+    Titles shared by several names are told apart by appending the name.
+    """
+    td = OrderedDict(title_dictionary(definition['children']))
+    shared = Counter(td.values())
 
-    import xlsxwriter
+    for item, value in td.items():
+        if shared[value] > 1:
+            td[item] = "{} ({})".format(value, item)
 
-    w = xlsxwriter.Workbook(output.name)
+    return td
 
-    for key, value in content.iteritems():
-        ws = w.add_worksheet(key)
 
-        columns = list(value[0].keys()) # list() is not need in Python 2.x
+class CompiledForm(object):
+    """
+    Everything do_work derives from a form definition alone: the pyxform
+    survey, the ExportBuilder with its sections, select multiple and gps
+    maps, the choice labels and the column titles.
+    """
 
-        for j, col in enumerate(columns):
-            ws.write(0, j, col)
+    def __init__(self, definition):
+        self.definition = definition
+        self.survey = create_survey_element_from_dict(definition)
+        self.export_builder = build_export_builder(self.survey)
+        self.sections = dict([(s['name'], s['elements']) for s in self.export_builder.sections])
+        self.choice_labels = compile_choice_labels(self.sections, self.survey)
+        self.titles = column_titles(definition)
 
-        for i, row in enumerate(value, start=1):
-            for j, col in enumerate(columns, start=1):
-                ws.write(i, j, row[col])
 
-    w.close()
-    output.flush()
+# compiled forms keyed by (pk, version, date_modified)
+compiled_forms = LRUCache(FORM_CACHE_SIZE)
 
 
-def do_work(pk, token):
+def compile_form(pk, token):
+    """
+    Returns the CompiledForm for the current version of a form, only
+    downloading and compiling its definition when that version is not cached.
+    """
     ona_api_url = ONA_API_URL
     headers = {"Authorization": "Token {}".format(token)}
 
     if ona_api_url.endswith('/'):
         ona_api_url = ona_api_url[:-1]
 
-    data = requests.get("{}/data/{}".format(ona_api_url, pk), headers=headers).json()
-    definition = requests.get("{}/forms/{}/form.json".format(ona_api_url, pk), headers=headers).json()
-
-    xform_survey = create_survey_element_from_dict(definition)
-
-    data = generate_export(definition, data, xform_survey=xform_survey)
-    sections = generate_sections(definition)
+    with timed('form_fetch'):
+        form = client.get("{}/forms/{}".format(ona_api_url, pk), headers=headers).json()
 
-    td = OrderedDict(title_dictionary(definition['children']))
-    dict_copy = td.copy()
-    keys_copy = list(td.keys())
+    if 'date_modified' not in form:
+        raise Exception(form)
 
-    for item in td.keys():
-        value = td[item]
-        keys = [k for k in keys_copy if value == dict_copy[k]]
+    key = (pk, form.get('version'), form['date_modified'])
+    compiled = compiled_forms.get(key)
 
-        if len(keys) <= 1:
-            continue
+    if compiled is None:
+        count('form_cache_misses')
+        with timed('form_fetch'):
+            with client.cached_get("{}/forms/{}/form.json".format(ona_api_url, pk), headers) as f:
+                definition = json.load(f)
+        with timed('compile'):
+            compiled = CompiledForm(definition)
+        compiled_forms.put(key, compiled)
+    else:
+        count('form_cache_hits')
 
-        keys.sort()
+    return compiled
 
-        fill = math.ceil(math.log(len(keys), 10))
 
-        # td[item] = "{} ({})".format(value, str(keys.index(item) + 1).zfill(int(fill)))
-        td[item] = "{} ({})".format(value, item)
+def label_sections(compiled, data):
+    """
+    Replaces choice names with their labels and renames the columns of the
+    SectionRows of every section in data to their titles, in place.
+    """
+    sections = compiled.sections
+    td = compiled.titles
+    choice_labels = compiled.choice_labels
 
-    for key, data_set in data.iteritems():
+    for key, rows in data.iteritems():
         section = sections[key]
         for s in section:
-            for d in data_set:
-                if s['xpath'] in d:
-                    name = d[s['xpath']]
-                    simplified_name = s['xpath'].split('/')[-1]
-
-                    if s['type'] in ['select', 'select1']:
-
-                        if s['type'] == 'select1':
-                            option = [l['label']['English'] if isinstance(l['label'], dict) else l['label']
-                                      for l in s['children']
-                                      if isinstance(l, dict) and l['name'] == name]
-                            if option:
-                                option = option.pop()
-                                d[s['xpath']] = option
-                            elif 'itemset' in s and s['itemset']:
-                                choices = xform_survey.choices.get(s['itemset'])
-                                if choices:
-                                    option = [l['label']['English'] if isinstance(l['label'], dict) else l['label']
-                                              for l in choices
-                                              if isinstance(l, dict) and l['name'] == name]
-                                    if option:
-                                        option = option.pop()
-                                        d[s['xpath']] = option
-                            else:
-                                print(name, " not found")
-                        else:
-                            name = name.split(' ')
-                            options = [l['label']['English'] if isinstance(l['label'], dict) else l['label']
-                                       for l in s['children']
-                                       if isinstance(l, dict) and l['name'] in name]
-                            # print("Options", options)
-                            if options:
-                                d[s['xpath']] = ", ".join(options)
-                            elif 'itemset' in s and s['itemset']:
-                                choices = xform_survey.choices.get(s['itemset'])
-                                if choices:
-                                    options = [l['label']['English'] if isinstance(l['label'], dict) else l['label']
-                                               for l in choices
-                                               if isinstance(l, dict) and l['name'] == name]
-                                    if options:
-                                        d[s['xpath']] = ", ".join(options)
-
-                    intermediate = d[s['xpath']]
-                    del d[s['xpath']]
-
-                    if simplified_name in td:
-                        d[td[simplified_name]] = intermediate
-                    else:
-                        d[simplified_name] = intermediate
-
-    section_name = data.keys()[0]
+            choices = choice_labels.get(s['xpath'])
+            if choices is not None:
+                rows.map_column(s['xpath'], lambda name: translate_choice(s, choices, name))
+
+            simplified_name = s['xpath'].split('/')[-1]
+            rows.rename(s['xpath'], td.get(simplified_name, simplified_name))
 
     return data
 
 
-def kobo_to_excel(pk, token, file_name):
-    import pandas
+# the CompiledForm of the export a transform process works for
+shard_form = None
 
-    data = do_work(pk, token)
 
-    for k in data.keys():
-        data[k.replace('/', '__')] = data.pop(k)
+def init_shard_worker(definition):
+    global shard_form
+    shard_form = CompiledForm(definition)
 
-    writer = pandas.ExcelWriter(file_name)
-    for key in data.keys():
-        df = pandas.DataFrame.from_dict(data[key])
-        if 'instanceID' in df:
-            df = df.set_index('instanceID').sort_values(by='start')
-        df.to_excel(writer, sheet_name=key[0:31])
-    writer.save()
+
+def transform_shard(args):
+    """
+    Runs in a transform process: the section rows of a slice of the
+    submissions, numbered as if they were the only submissions.
+    """
+    submissions, pre_process, label, columnar = args
+    data = shard_form.export_builder.to_dict(submissions, pre_process=pre_process, columnar=columnar)
+    if label:
+        label_sections(shard_form, data)
+    return data
+
+
+def iter_shards(submissions, pre_process, label, columnar=False, size=None):
+    size = size or SHARD_SIZE
+    shard = []
+    for submission in submissions:
+        shard.append(submission)
+        if len(shard) >= size:
+            yield shard, pre_process, label, columnar
+            shard = []
+    if shard:
+        yield shard, pre_process, label, columnar
+
+
+def merge_shards(shards, section_names):
+    """
+    Concatenates the section rows of consecutive shards, shifting their
+    _index and _parent_index by the rows earlier shards already had in the
+    same section so that they are numbered as to_dict would number them.
+    """
+    data = dict((name, SectionRows()) for name in section_names)
+    offsets = dict.fromkeys(section_names, 0)
+
+    for shard in shards:
+        for name, rows in shard.iteritems():
+            offset = offsets[name]
+            for i in range(len(rows)):
+                rows.set(i, INDEX, rows.get(i, INDEX) + offset)
+                parent = rows.get(i, PARENT_TABLE_NAME)
+                if parent in offsets:
+                    rows.set(i, PARENT_INDEX, rows.get(i, PARENT_INDEX) + offsets[parent])
+            if not data[name]:
+                data[name] = rows
+            else:
+                data[name].extend(rows)
+
+        for name, rows in shard.iteritems():
+            offsets[name] += len(rows)
+
+    return data
+
+
+def transform_submissions(compiled, submissions, processes=None, pre_process=True, label=False,
+                          columnar=False):
+    """
+    The section rows of submissions, as ExportBuilder.to_dict returns them
+    and labelled by label_sections if label is set. With columnar set they
+    are pre processed a column at a time, by pre_process_columns. With more than one
+    process the submissions are split in shards converted by a pool of
+    processes, each of which compiles the form definition once.
+    """
+    if processes is None:
+        processes = TRANSFORM_PROCESSES
+
+    if processes <= 1:
+        with timed('transform'):
+            data = compiled.export_builder.to_dict(submissions, pre_process=pre_process, columnar=columnar)
+        if label:
+            with timed('labels'):
+                label_sections(compiled, data)
+    else:
+        pool = Pool(processes, initializer=init_shard_worker, initargs=(compiled.definition,))
+        try:
+            with timed('transform'):
+                shards = pool.imap(transform_shard, iter_shards(submissions, pre_process, label, columnar))
+                data = merge_shards(shards, [section['name'] for section in compiled.export_builder.sections])
+        finally:
+            pool.terminate()
+
+    count('sections', len(data))
+    count('rows', sum(len(rows) for rows in data.values()))
+    return data
+
+
+def do_work(pk, token, processes=None, columnar=False, synced=False):
+    compiled = compile_form(pk, token)
+    if not synced:
+        sync_submissions(pk, token)
+
+    return transform_submissions(compiled, submission_store.iter_submissions(pk), processes, label=True,
+                                 columnar=columnar)
+
+
+def exceeds_memory_budget(pk, token, synced=False):
+    """
+    Whether exporting the form in memory is expected to take the process
+    over MEMORY_BUDGET, judging by the size of its stored submissions.
+    Unless synced is set, the store is synced first.
+    """
+    if not MEMORY_BUDGET:
+        return False
+
+    if not synced:
+        sync_submissions(pk, token)
+    estimate = submission_store.size(pk) * MEMORY_PER_JSON_BYTE
+    if current_rss() + estimate <= MEMORY_BUDGET:
+        return False
+
+    count('spilled_exports')
+    return True
+
+
+def sheet_titles(names):
+    """
+    Maps every section name to the title of its worksheet: slashes replaced
+    by __, cut to Excel's 31 characters and made unique.
+    """
+    titles = OrderedDict()
+    for name in names:
+        titles[name] = ExportBuilder.get_valid_sheet_name(name.replace('/', '__'), list(titles.values()))
+    return titles
+
+
+def kobo_to_excel(pk, token, file_name):
+    import pandas
+
+    sync_submissions(pk, token)
+    if exceeds_memory_budget(pk, token, synced=True):
+        with open(file_name, 'wb') as output:
+            for chunk in spilled_excel(pk, token, synced=True):
+                output.write(chunk)
+        count('written_bytes', os.path.getsize(file_name))
+        return
+
+    # the rows only go into DataFrames, so they are converted a column at a time
+    data = do_work(pk, token, columnar=True, synced=True)
+
+    with timed('write'):
+        writer = pandas.ExcelWriter(file_name)
+        for key, title in sheet_titles(data.keys()).items():
+            df = data.pop(key).to_frame()
+            if 'instanceID' in df:
+                df = df.set_index('instanceID').sort_values(by='start')
+            df.to_excel(writer, sheet_name=title)
+        writer.save()
+
+    count('written_bytes', os.path.getsize(file_name))
+
+
+def excel_rows(rows):
+    """
+    Lays out the rows of a section the way kobo_to_excel writes them: the
+    index column followed by the sorted columns, indexed by instanceID and
+    sorted by start when the section has an instanceID.
+    """
+    columns = sorted(rows.present_columns())
+    index = None
+    values = rows.iter_values([None] + columns)
+
+    if 'instanceID' in columns:
+        index = 'instanceID'
+        columns.remove(index)
+        values = rows.iter_values([index] + columns)
+        if 'start' in columns:
+            start = 1 + columns.index('start')
+            values = sorted(values, key=lambda row: (row[start] is None, row[start] or ''))
+
+    yield [index] + columns
+    for i, row in enumerate(values):
+        if index is None:
+            row[0] = i
+        yield row
+
+
+class SpilledSection(object):
+    """
+    The rows of a section pickled one after the other into a temporary
+    file, with the columns they use and where each one starts.
+    """
+
+    def __init__(self):
+        self.file = TemporaryFile()
+        self.columns = set()
+        self.offsets = []
+
+    def append(self, row):
+        start = row.get('start')
+        self.offsets.append(((start is None, start or ''), self.file.tell()))
+        self.columns.update(row.keys())
+        pickle.dump(row, self.file, pickle.HIGHEST_PROTOCOL)
+
+    def __iter__(self):
+        self.file.seek(0)
+        for offset in self.offsets:
+            yield pickle.load(self.file)
+
+    def sorted_by_start(self):
+        for key, offset in sorted(self.offsets, key=itemgetter(0)):
+            self.file.seek(offset)
+            yield pickle.load(self.file)
+
+    def close(self):
+        self.file.close()
+
+
+def spill_sections(compiled, submissions, label=True, pre_process=True):
+    """
+    do_work with every section written to a SpilledSection as its rows are
+    produced, so only one submission is in memory at a time. label and
+    pre_process are as for transform_submissions.
+    """
+    sections = dict((section['name'], SpilledSection()) for section in compiled.export_builder.sections)
+    for section, row in compiled.export_builder.iter_rows(submissions, pre_process):
+        if label:
+            rows = SectionRows()
+            rows.append(row)
+            label_sections(compiled, {section['name']: rows})
+            row = next(iter(rows))
+        sections[section['name']].append(row)
+    return sections
+
+
+def close_sections(sections):
+    for section in sections.values():
+        section.close()
+
+
+def spilled_excel_rows(section):
+    """
+    excel_rows for a SpilledSection, reading its rows back from disk.
+    """
+    columns = sorted(section.columns)
+    index = None
+    rows = iter(section)
+
+    if 'instanceID' in columns:
+        index = 'instanceID'
+        columns.remove(index)
+        if 'start' in columns:
+            rows = section.sorted_by_start()
+
+    yield [index] + columns
+    for i, row in enumerate(rows):
+        yield [row.get(index) if index else i] + [row.get(col) for col in columns]
+
+
+def spilled_excel(pk, token, synced=False):
+    """
+    stream_excel for forms over the memory budget: the rows of every section
+    are spilled to temporary files, then streamed into the workbook. Unless
+    synced is set, the store is synced first.
+    """
+    compiled = compile_form(pk, token)
+    if not synced:
+        sync_submissions(pk, token)
+
+    with timed('spill'):
+        sections = spill_sections(compiled, submission_store.iter_submissions(pk))
+
+    def generate():
+        try:
+            for chunk in iter_xlsx((title, spilled_excel_rows(sections[key]))
+                                   for key, title in sheet_titles(sections.keys()).items()):
+                yield chunk
+        finally:
+            close_sections(sections)
+
+    return generate()
+
+
+def count_written(chunks):
+    for chunk in chunks:
+        count('written_bytes', len(chunk))
+        yield chunk
+
+
+def stream_excel(pk, token):
+    """
+    Exports a form like kobo_to_excel, but returns the workbook as an
+    iterator of byte strings produced while the rows are written, instead
+    of saving it to a file.
+    """
+    sync_submissions(pk, token)
+    if exceeds_memory_budget(pk, token, synced=True):
+        return count_written(spilled_excel(pk, token, synced=True))
+
+    data = do_work(pk, token, synced=True)
+
+    # sections are dropped from data as soon as they have been handed over
+    return count_written(iter_xlsx((title, excel_rows(data.pop(key))) for key, title in sheet_titles(data.keys()).items()))
+
+
+def stream_zipped_csv(pk, token):
+    """
+    Returns the bytes of a zip with one CSV per section of the form as an
+    iterator, produced while the submissions are read from the store.
+    """
+    compiled = compile_form(pk, token)
+    sync_submissions(pk, token)
+
+    return count_written(compiled.export_builder.iter_zipped_csv(submission_store.iter_submissions(pk)))
+
+
+def export_form_to_file(pk, token, directory=None, cancelled=None):
+    """
+    Runs kobo_to_excel into a new temporary file in directory. Returns the
+    pk with the path of the file, or with the error that stopped the export.
+    Does nothing once the threading.Event cancelled is set.
+    """
+    if cancelled is not None and cancelled.is_set():
+        return pk, None, "Cancelled"
+
+    fd, path = mkstemp(suffix='.xlsx', dir=directory)
+    os.close(fd)
+
+    try:
+        kobo_to_excel(pk, token, path)
+        return pk, path, None
+    except Exception as e:
+        os.remove(path)
+        return pk, None, "{}".format(e)
+
+
+def read_chunks(path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def remove_when_done(pool, directory):
+    """
+    Waits for the tasks of a closed pool to finish, then removes directory.
+    """
+    pool.join()
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def stream_batch(pks, token, workers=BATCH_WORKERS):
+    """
+    Returns the bytes of a zip with the workbook of every form in pks as an
+    iterator. Up to workers forms are fetched and exported at the same time;
+    a form that fails gets a {pk}-error.txt entry instead of its workbook.
+    """
+    def generate():
+        # started on the first read, so an iterator that is never read
+        # leaves nothing behind. The workbooks go to a directory of their
+        # own, removed with whatever is left in it however the zip ends,
+        # e.g. when the client goes away
+        directory = mkdtemp()
+        cancelled = threading.Event()
+        pool = ThreadPool(max(1, min(workers, len(pks))))
+        results = pool.imap(partial(export_form_to_file, token=token, directory=directory, cancelled=cancelled), pks)
+        archive = ZipStream()
+        try:
+            for pk, path, error in results:
+                if error is not None:
+                    entry = archive.write_entry('{}-error.txt'.format(pk), [error.encode('utf-8')])
+                else:
+                    entry = archive.write_entry('{}.xlsx'.format(pk), read_chunks(path))
+
+                try:
+                    for data in entry:
+                        yield data
+                finally:
+                    if path is not None:
+                        os.remove(path)
+
+            for data in archive.finish():
+                yield data
+        finally:
+            # exports not started yet return at once, those running are
+            # waited for in the background so the request is not held up
+            # by them, and only then is their directory removed
+            cancelled.set()
+            pool.close()
+            cleanup = threading.Thread(target=remove_when_done, args=(pool, directory))
+            cleanup.daemon = True
+            cleanup.start()
+
+    return generate()
 
 
 def fetch_api_key(username, password):
     ona_api_url = ONA_API_URL
-    response = requests.get("{}/user".format(ona_api_url), auth=(username, password))
+    response = client.get("{}/user".format(ona_api_url), auth=(username, password))
 
     data = response.json()
 
@@ -213,3 +912,57 @@ def fetch_api_key(username, password):
         raise Exception(data)
 
     return data['api_token']
+
+
+# a forms list as the API returned it, gzipped, with its validators
+FormList = namedtuple('FormList', ['body', 'gzipped', 'etag', 'last_modified', 'fetched_at'])
+
+# forms lists keyed by a hash of the token they were fetched with
+form_lists = LRUCache(FORMS_CACHE_SIZE)
+
+
+def gzip_bytes(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def fetch_form_list(token):
+    """
+    Returns the FormList of the forms the token can see. It is served from
+    memory for FORMS_CACHE_TTL seconds, then revalidated with the API using
+    If-None-Match/If-Modified-Since so an unchanged list is not downloaded
+    again.
+    """
+    key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    cached = form_lists.get(key)
+    now = time.time()
+
+    if cached is not None and now - cached.fetched_at < FORMS_CACHE_TTL:
+        count('form_list_cache_hits')
+        return cached
+
+    headers = {"Authorization": "Token {}".format(token)}
+    if cached is not None:
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+
+    with timed('form_list_fetch'):
+        response = client.get("{}/forms".format(ONA_API_URL), headers=headers)
+
+    if cached is not None and response.status_code == 304:
+        count('form_list_revalidated')
+        form_list = cached._replace(fetched_at=now)
+    else:
+        count('form_list_cache_misses')
+        form_list = FormList(response.content, gzip_bytes(response.content), response.headers.get('ETag'),
+                             response.headers.get('Last-Modified'), now)
+        if not response.ok:
+            # errors, e.g. an invalid token, are passed on but not cached
+            return form_list
+
+    form_lists.put(key, form_list)
+    return form_list